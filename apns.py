@@ -23,14 +23,25 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+from array import array
+from base64 import urlsafe_b64encode
 from binascii import a2b_hex, b2a_hex
+from bisect import bisect_right
+from collections import deque
+from itertools import chain, count
 from datetime import datetime
+from hashlib import sha256
+from math import frexp, ldexp
 from time import mktime
-from socket import socket, AF_INET, SOCK_STREAM, timeout, error as socket_error
-from struct import pack, unpack
+from socket import socket, AF_INET, SOCK_STREAM, SOCK_DGRAM, timeout, error as socket_error
+from struct import pack, unpack, Struct
+from threading import Lock, RLock, Thread
+from weakref import ref
 
 import select
 import errno
+import logging
+import time
 
 support_enhanced = True
 
@@ -41,32 +52,119 @@ except ImportError:
     from socket import ssl as wrap_socket
     support_enhanced = False
 
+try:
+    from ssl import SSLContext, PROTOCOL_SSLv23
+except ImportError:
+    # Python < 2.7.9
+    SSLContext = None
+
 try:
     import json
 except ImportError:
     import simplejson as json
 
+try:
+    from hyper import HTTP20Connection
+    from hyper.tls import init_context
+    support_http2 = True
+except ImportError:
+    support_http2 = False
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from ecdsa import SigningKey
+    from ecdsa.util import sigencode_string
+    support_provider_token = True
+except ImportError:
+    support_provider_token = False
+
 from apnserrors import *
 
 MAX_PAYLOAD_LENGTH = 256
+TOKEN_LENGTH = 32
+FEEDBACK_BUFFER_SIZE = 65536
+FEEDBACK_BATCH_SIZE = 10000
 TIMEOUT = 60
 ERROR_RESPONSE_LENGTH = 6
+FLUSH_SIZE = 65536
+FLUSH_INTERVAL = 1.0
+ERROR_READER_INTERVAL = 1.0
+KEEPER_INTERVAL = 5.0
+IDLE_TTL = 5 * 60
+MAX_CONCURRENT_STREAMS = 500
+PROVIDER_TOKEN_REFRESH_INTERVAL = 50 * 60
+BACKOFF_FACTOR = 0.5
+POOL_RESEND_WINDOW = 1000
+MAX_IDENTIFIER = 0xFFFFFFFF
+STATSD_PORT = 8125
 
 class APNs(object):
     """A class representing an Apple Push Notification service connection"""
 
-    def __init__(self, use_sandbox=False, cert_file=None, key_file=None, enhanced=False):
+    def __init__(self, use_sandbox=False, cert_file=None, key_file=None, enhanced=False,
+                 resend_window=0, error_callback=None, error_reader=False, pool_size=4,
+                 pool_dispatch='round_robin', topic=None, provider_token=None,
+                 pacing=None, metrics=None, keep_alive=False, idle_ttl=IDLE_TTL):
         """
         Set use_sandbox to True to use the sandbox (test) APNs servers.
         Default is False.
+
+        In enhanced mode, set resend_window to the number of sent
+        notifications the gateway connection should keep to resend them
+        itself after an error response. Their identifiers must then be
+        unique. See GatewayConnection.
+
+        In enhanced mode, set error_reader to True to wait for error
+        responses in a background thread instead of polling the socket
+        before every write. See ErrorResponseReader.
+
+        pool_size and pool_dispatch configure the connections of
+        gateway_pool, which keep a resend window in enhanced mode even
+        without resend_window. See GatewayConnectionPool.
+
+        topic is the apns-topic, usually the app's bundle id, sent with
+        notifications by http2_server. To authenticate http2_server with a
+        token rather than a certificate, pass a ProviderToken as
+        provider_token.
+
+        pacing is a TokenBucket, or a list of them, that paces the
+        notifications of gateway_server and gateway_pool. See TokenBucket.
+
+        metrics is a Metrics sink that the feedback and gateway connections
+        report to. See Metrics.
+
+        Set keep_alive to True to open gateway_server right away and keep it,
+        and the connections of gateway_pool, open in the background,
+        reconnecting them after idle_ttl seconds without a write. See
+        ConnectionKeeper.
         """
         super(APNs, self).__init__()
         self.use_sandbox = use_sandbox
         self.cert_file = cert_file
         self.key_file = key_file
         self.enhanced = enhanced and support_enhanced
+        self.resend_window = resend_window
+        self.error_callback = error_callback
+        self.error_reader = error_reader
+        self.pool_size = pool_size
+        self.pool_dispatch = pool_dispatch
+        self.topic = topic
+        self.provider_token = provider_token
+        self.pacing = pacing
+        self.metrics = metrics
+        self.keep_alive = keep_alive
+        self.idle_ttl = idle_ttl
         self._feedback_connection = None
         self._gateway_connection = None
+        self._gateway_pool = None
+        self._http2_connection = None
+        if keep_alive:
+            # pre-warm the gateway connection
+            self.gateway_server
 
     @staticmethod
     def unpacked_uchar_big_endian(byte):
@@ -110,7 +208,8 @@ class APNs(object):
             self._feedback_connection = FeedbackConnection(
                 use_sandbox = self.use_sandbox,
                 cert_file = self.cert_file,
-                key_file = self.key_file
+                key_file = self.key_file,
+                metrics = self.metrics
             )
         return self._feedback_connection
 
@@ -121,34 +220,264 @@ class APNs(object):
                 use_sandbox = self.use_sandbox,
                 cert_file = self.cert_file,
                 key_file = self.key_file,
-                enhanced = self.enhanced
+                enhanced = self.enhanced,
+                resend_window = self.resend_window,
+                error_callback = self.error_callback,
+                error_reader = self.error_reader,
+                pacing = self.pacing,
+                metrics = self.metrics,
+                keep_alive = self.keep_alive,
+                idle_ttl = self.idle_ttl
             )
         return self._gateway_connection
 
+    @property
+    def gateway_pool(self):
+        if not self._gateway_pool:
+            self._gateway_pool = GatewayConnectionPool(
+                self.pool_size,
+                dispatch = self.pool_dispatch,
+                use_sandbox = self.use_sandbox,
+                cert_file = self.cert_file,
+                key_file = self.key_file,
+                enhanced = self.enhanced,
+                resend_window = self.resend_window,
+                error_callback = self.error_callback,
+                error_reader = self.error_reader,
+                pacing = self.pacing,
+                metrics = self.metrics,
+                keep_alive = self.keep_alive,
+                idle_ttl = self.idle_ttl
+            )
+        return self._gateway_pool
+
+    @property
+    def http2_server(self):
+        if not self._http2_connection:
+            self._http2_connection = HTTP2Connection(
+                use_sandbox = self.use_sandbox,
+                cert_file = self.cert_file,
+                key_file = self.key_file,
+                topic = self.topic,
+                provider_token = self.provider_token
+            )
+        return self._http2_connection
+
+
+class Metrics(object):
+    """
+    The sink connections report their metrics to. This base class discards
+    them, and as enabled is False the connections don't even measure them.
+    Subclasses implement count(), for counters such as bytes written,
+    timing(), for latencies in seconds, and observe(), for other values
+    whose distribution matters, such as flush sizes.
+    """
+    enabled = False
+
+    def count(self, name, value=1):
+        pass
+
+    def timing(self, name, seconds):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+
+NULL_METRICS = Metrics()
+
+
+class MemoryMetrics(Metrics):
+    """
+    Keeps counters and histograms in memory. Histograms record the count,
+    sum, minimum and maximum of their values, and how many fell into each
+    power of two bucket. snapshot() returns a copy of them.
+    """
+    enabled = True
+
+    def __init__(self):
+        super(MemoryMetrics, self).__init__()
+        self._counters = {}
+        self._histograms = {}
+        self._lock = Lock()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        # values in (2 ** (e - 1), 2 ** e] go into bucket e
+        mantissa, exponent = frexp(value)
+        if mantissa == 0.5:
+            exponent -= 1
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = [0, 0, value, value, {}]
+            histogram[0] += 1
+            histogram[1] += value
+            histogram[2] = min(histogram[2], value)
+            histogram[3] = max(histogram[3], value)
+            histogram[4][exponent] = histogram[4].get(exponent, 0) + 1
+
+    timing = observe
+
+    def snapshot(self):
+        """
+        Returns {'counters': {name: value}, 'histograms': {name: {'count',
+        'sum', 'min', 'max', 'buckets': {upper bound: count}}}}
+        """
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'histograms': dict(
+                    (name, {'count': n, 'sum': total, 'min': low, 'max': high,
+                            'buckets': dict((ldexp(1, e), c) for e, c in buckets.items())})
+                    for name, (n, total, low, high, buckets) in self._histograms.items())
+            }
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+class LoggingMetrics(Metrics):
+    """Logs every metric to logger, the 'apns' logger by default"""
+    enabled = True
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        super(LoggingMetrics, self).__init__()
+        self.logger = logger or logging.getLogger('apns')
+        self.level = level
+
+    def count(self, name, value=1):
+        self.logger.log(self.level, '%s +%s', name, value)
+
+    def timing(self, name, seconds):
+        self.logger.log(self.level, '%s %.3fms', name, seconds * 1000)
+
+    def observe(self, name, value):
+        self.logger.log(self.level, '%s %s', name, value)
+
+
+class StatsdMetrics(Metrics):
+    """
+    Sends every metric to a statsd server over UDP, as counters (|c),
+    timings in milliseconds (|ms) and histograms (|h)
+    """
+    enabled = True
+
+    def __init__(self, host='localhost', port=STATSD_PORT, prefix='apns'):
+        super(StatsdMetrics, self).__init__()
+        self.address = (host, port)
+        self.prefix = prefix + '.' if prefix else ''
+        self._socket = socket(AF_INET, SOCK_DGRAM)
+
+    def _send(self, line):
+        try:
+            self._socket.sendto(line, self.address)
+        except socket_error:
+            # metrics are best effort
+            pass
+
+    def count(self, name, value=1):
+        self._send('%s%s:%d|c' % (self.prefix, name, value))
+
+    def timing(self, name, seconds):
+        self._send('%s%s:%.3f|ms' % (self.prefix, name, seconds * 1000))
+
+    def observe(self, name, value):
+        self._send('%s%s:%s|h' % (self.prefix, name, value))
+
+
+_ssl_contexts = {}
+_ssl_contexts_lock = Lock()
+
+
+def ssl_context(cert_file, key_file, use_sandbox=False, http2=False):
+    """
+    Returns the SSLContext for cert_file and key_file, shared by all
+    connections of the process, so that the certificate and key are only
+    read and parsed once. http2 selects a context for the HTTP/2 provider
+    API. Returns None if the ssl module has no SSLContext.
+    """
+    key = (cert_file, key_file, use_sandbox, http2)
+    context = _ssl_contexts.get(key)
+    if context is not None or not (SSLContext or http2):
+        return context
+    with _ssl_contexts_lock:
+        context = _ssl_contexts.get(key)
+        if context is None:
+            if http2:
+                context = init_context(cert=(cert_file, key_file) if cert_file else None)
+            else:
+                context = SSLContext(PROTOCOL_SSLv23)
+                if cert_file:
+                    context.load_cert_chain(cert_file, key_file)
+            _ssl_contexts[key] = context
+        return context
+
+
+def clear_ssl_contexts():
+    """Drops the cached SSLContexts, e.g. after a certificate was renewed"""
+    with _ssl_contexts_lock:
+        _ssl_contexts.clear()
+
 
 class APNsConnection(object):
     """
     A generic connection class for communicating with the APNs
     """
-    def __init__(self, cert_file=None, key_file=None, enhanced=False):
+    def __init__(self, cert_file=None, key_file=None, enhanced=False, error_reader=False,
+                 metrics=None):
         super(APNsConnection, self).__init__()
         self.cert_file = cert_file
         self.key_file = key_file
         self.enhanced = enhanced
+        self.error_reader = error_reader
         self._socket = None
         self._ssl = None
+        # reentrant, so that GatewayConnection can write and update its
+        # resend window without an ErrorResponseReader in between
+        self._lock = RLock()
+        self._error_response = None
+        # the error response last passed to _report_error_response
+        self._reported = None
+        self.metrics = metrics or NULL_METRICS
+        self.use_sandbox = False
+        self._connects = 0
+        self._last_used = 0
 
     def __del__(self):
         self._disconnect();
 
     def _connect(self):
+        if self.metrics.enabled:
+            started = time.time()
+            self._connect_ssl()
+            self.metrics.timing('connect', time.time() - started)
+            self.metrics.count('connects')
+            if self._connects:
+                self.metrics.count('reconnects')
+        else:
+            self._connect_ssl()
+        self._connects += 1
+        self._last_used = time.time()
+
+    def _wrap_socket(self, **kwargs):
+        context = ssl_context(self.cert_file, self.key_file, self.use_sandbox)
+        if context is None:
+            return wrap_socket(self._socket, self.key_file, self.cert_file, **kwargs)
+        return context.wrap_socket(self._socket, **kwargs)
+
+    def _connect_ssl(self):
         # Establish an SSL connection
         self._socket = socket(AF_INET, SOCK_STREAM)
         self._socket.connect((self.server, self.port))
 
         if self.enhanced:
-            self._ssl = wrap_socket(self._socket, self.key_file, self.cert_file,
-                                    do_handshake_on_connect=False)
+            self._ssl = self._wrap_socket(do_handshake_on_connect=False)
             self._ssl.setblocking(0)
             while True:
                 try:
@@ -161,8 +490,10 @@ class APNsConnection(object):
                         select.select([], [self._ssl], [])
                     else:
                         raise
+            if self.error_reader:
+                ErrorResponseReader(self).start()
         else:
-            self._ssl = wrap_socket(self._socket, self.key_file, self.cert_file)
+            self._ssl = self._wrap_socket()
 
     def _disconnect(self):
         if self._socket:
@@ -180,65 +511,295 @@ class APNsConnection(object):
     def recvall(self, n):
         data = ""
         while True:
-            more = self._connection().recv(n - len(data))
-            data += more
-            if len(data) >= n:
-                break
+            try:
+                more = self._connection().recv(n - len(data))
+            except SSLError, err:
+                # a non-blocking socket can be readable with no application
+                # data to return, e.g. after a TLS 1.3 session ticket
+                if SSL_ERROR_WANT_READ != err.args[0] or not data:
+                    raise
+            else:
+                data += more
+                if len(data) >= n or not more:
+                    break
             rlist, _, _ = select.select([self._connection()], [], [], TIMEOUT)
             if not rlist:
                 raise timeout
 
         return data
             
-    def write(self, string):
-        if self.enhanced: # nonblocking socket
-            rlist, _, _ = select.select([self._connection()], [], [], 0)
+    def _read_error_response(self):
+        """
+        Reads an error response from the APNs, closes the connection and
+        returns the matching APNResponseError. Returns None if the
+        connection was closed before a complete response could be read.
+        """
+        buff = self.recvall(ERROR_RESPONSE_LENGTH)
+        if len(buff) != ERROR_RESPONSE_LENGTH:
+            return None
 
-            if rlist: # there's error response from APNs
-                buff = self.recvall(ERROR_RESPONSE_LENGTH)
-                if len(buff) != ERROR_RESPONSE_LENGTH:
-                    return None
+        command = APNs.unpacked_uchar_big_endian(buff[0])
 
-                command = APNs.unpacked_uchar_big_endian(buff[0])
+        if 8 != command:
+            self._disconnect()
+            return UnknownError(0)
 
-                if 8 != command:
+        status = APNs.unpacked_uchar_big_endian(buff[1])
+        identifier = APNs.unpacked_uint_big_endian(buff[2:6])
+
+        self._disconnect()
+
+        if self.metrics.enabled:
+            self.metrics.count('error_responses.%d' % status)
+
+        return { 1: ProcessingError,
+                 2: MissingDeviceTokenError,
+                 3: MissingTopicError,
+                 4: MissingPayloadError,
+                 5: InvalidTokenSizeError,
+                 6: InvalidTopicSizeError,
+                 7: InvalidPayloadSizeError,
+                 8: InvalidTokenError,
+                 10: ShutdownError}.get(status, UnknownError)(identifier)
+
+    def _report_error_response(self, err):
+        """Called by ErrorResponseReader, outside the lock, with each error response it reads"""
+        pass
+
+    def _check_error_response(self):
+        """
+        Raises the matching APNResponseError if the APNs has sent an error
+        response on this connection. Only meaningful in enhanced mode.
+        """
+        # left by ErrorResponseReader or ConnectionKeeper
+        err = self._error_response
+        if err:
+            self._error_response = None
+            raise err
+        if self.error_reader:
+            return
+
+        rlist, _, _ = select.select([self._connection()], [], [], 0)
+
+        if rlist: # there's error response from APNs
+            try:
+                err = self._read_error_response()
+            except SSLError, ssl_err:
+                if SSL_ERROR_WANT_READ == ssl_err.args[0]:
+                    # only TLS records, no error response
+                    return
+                raise
+            if err:
+                raise err
+
+    def wait_for_error_response(self, wait):
+        """
+        Waits up to wait seconds for an error response to what has been
+        written and raises it as the matching APNResponseError. Returns once
+        wait seconds have passed or the connection is closed without one, in
+        which case it is disconnected. Only meaningful in enhanced mode, as
+        the APNs doesn't confirm notifications it accepts.
+        """
+        if not self.enhanced:
+            return
+        deadline = time.time() + wait
+        while True:
+            with self._lock:
+                ssl_socket = self._ssl
+                # left by ErrorResponseReader or ConnectionKeeper
+                err, self._error_response = self._error_response, None
+                if err:
+                    raise err
+                if ssl_socket is None:
+                    return
+            remaining = deadline - time.time()
+            try:
+                rlist, _, _ = select.select([ssl_socket], [], [], max(remaining, 0))
+            except (select.error, socket_error, ValueError):
+                rlist = []
+            if rlist and not self.error_reader:
+                with self._lock:
+                    if self._ssl is not ssl_socket:
+                        continue
+                    try:
+                        err = self._read_error_response()
+                    except SSLError, ssl_err:
+                        if SSL_ERROR_WANT_READ == ssl_err.args[0]:
+                            # only TLS records, no error response
+                            continue
+                        err = None
+                    except (socket_error, timeout):
+                        err = None
+                    if err:
+                        raise err
+                    # closed without an error response, cleanly or not
                     self._disconnect()
-                    raise UnknownError(0)
+                    return
+            if remaining <= 0:
+                return
 
-                status = APNs.unpacked_uchar_big_endian(buff[1])
-                identifier = APNs.unpacked_uint_big_endian(buff[2:6])
+    def _probe(self):
+        """
+        Checks an idle connection without blocking. If the APNs has sent an
+        error response it is left for the next write to raise; if it has
+        closed the connection, it is disconnected. Returns whether the
+        connection is still open.
+        """
+        try:
+            rlist, _, _ = select.select([self._ssl], [], [], 0)
+        except (select.error, socket_error, ValueError):
+            self._disconnect()
+            return False
+        if not rlist:
+            return True
+        blocking = not self.enhanced
+        if blocking:
+            self._ssl.setblocking(0)
+        try:
+            err = self._read_error_response()
+        except SSLError, ssl_err:
+            if SSL_ERROR_WANT_READ == ssl_err.args[0]:
+                # only TLS records, e.g. a session ticket
+                return True
+            err = None
+        except (socket_error, timeout):
+            err = None
+        finally:
+            if blocking and self._ssl:
+                self._ssl.setblocking(1)
+        if err:
+            self._error_response = err
+        self._disconnect()
+        return False
 
+    def _keep_alive(self, idle_ttl):
+        """
+        Opens the connection if it isn't, reopens it if the APNs has closed
+        it or it has been idle for idle_ttl seconds. Does nothing while the
+        connection is in use.
+        """
+        if not self._lock.acquire(False):
+            return
+        try:
+            if self._ssl and self._probe() and time.time() - self._last_used >= idle_ttl:
                 self._disconnect()
-                
-                raise { 1: ProcessingError,
-                        2: MissingDeviceTokenError,
-                        3: MissingTopicError,
-                        4: MissingPayloadError,
-                        5: InvalidTokenSizeError,
-                        6: InvalidTopicSizeError,
-                        7: InvalidPayloadSizeError,
-                        8: InvalidTokenError,
-                        10: ShutdownError}.get(status, UnknownError)(identifier)
-
-            _, wlist, _ = select.select([], [self._connection()], [], TIMEOUT)
-            if wlist:
-                return self._connection().sendall(string)
-            else:
-                self._disconnect()
-                raise timeout
+            if not self._ssl:
+                self._connect()
+        except (SSLError, socket_error, timeout):
+            # try again on the next round
+            self._disconnect()
+        finally:
+            self._lock.release()
+
+    def write(self, string):
+        self._last_used = time.time()
+        if self.enhanced: # nonblocking socket
+            with self._lock:
+                self._check_error_response()
+
+                if self.metrics.enabled:
+                    started = time.time()
+                    _, wlist, _ = select.select([], [self._connection()], [], TIMEOUT)
+                    self.metrics.timing('write.select', time.time() - started)
+                    self.metrics.count('write.bytes', len(string))
+                else:
+                    _, wlist, _ = select.select([], [self._connection()], [], TIMEOUT)
+                if wlist:
+                    return self._connection().sendall(string)
+                else:
+                    self._disconnect()
+                    raise timeout
         
         else: # not-enhanced format using blocking socket
+            if self.metrics.enabled:
+                self.metrics.count('write.bytes', len(string))
+            with self._lock:
+                try:
+                    return self._connection().write(string)
+                except socket_error, err:
+                    try:
+                        if errno.EPIPE == err.errno:
+                            self._disconnect()
+                    except AttributeError:
+                        if errno.EPIPE == err.args[0]:
+                            self._disconnect()
+                    finally:
+                        raise err
+
+class ErrorResponseReader(Thread):
+    """
+    A daemon thread that waits for an error response on an enhanced
+    connection and leaves it for the next write to raise, so that writes
+    don't have to poll the socket before every frame. The connection also
+    gets to report it right away, see GatewayConnection. It stops once the
+    connection it was started for is closed or replaced.
+    """
+    def __init__(self, connection):
+        super(ErrorResponseReader, self).__init__()
+        self.daemon = True
+        self._connection = ref(connection)
+        self._ssl = connection._ssl
+
+    def run(self):
+        while True:
+            # don't keep the connection alive while waiting
+            connection = None
             try:
-                return self._connection().write(string)
-            except socket_error, err:
+                rlist, _, _ = select.select([self._ssl], [], [], ERROR_READER_INTERVAL)
+            except (select.error, socket_error, ValueError):
+                return
+            connection = self._connection()
+            if connection is None or connection._ssl is not self._ssl:
+                return
+            if not rlist:
+                continue
+            with connection._lock:
+                if connection._ssl is not self._ssl:
+                    return
                 try:
-                    if errno.EPIPE == err.errno:
-                        self._disconnect()
-                except AttributeError:
-                    if errno.EPIPE == err.args[0]:
-                        self._disconnect()
-                finally:
-                    raise err
+                    err = connection._read_error_response()
+                except SSLError, err:
+                    if SSL_ERROR_WANT_READ == err.args[0]:
+                        continue
+                    connection._disconnect()
+                    return
+                except (socket_error, timeout):
+                    connection._disconnect()
+                    return
+                if err:
+                    connection._error_response = connection._reported = err
+                else:
+                    connection._disconnect()
+            if err:
+                connection._report_error_response(err)
+            return
+
+class ConnectionKeeper(Thread):
+    """
+    A daemon thread that keeps a connection hot, so that the first write of
+    a burst doesn't wait for DNS, TCP and TLS. It opens the connection right
+    away, then every interval seconds probes it while it is idle, reopening
+    it when the APNs has closed it, as it does with connections that sit
+    idle, and once it has been idle for idle_ttl seconds. An error response
+    it reads is left for the next write to raise. It stops once the
+    connection is garbage collected.
+    """
+    def __init__(self, connection, interval=KEEPER_INTERVAL, idle_ttl=IDLE_TTL):
+        super(ConnectionKeeper, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.idle_ttl = idle_ttl
+        self._connection = ref(connection)
+
+    def run(self):
+        while True:
+            connection = self._connection()
+            if connection is None:
+                return
+            connection._keep_alive(self.idle_ttl)
+            # don't keep the connection alive while waiting
+            connection = None
+            time.sleep(self.interval)
 
 class PayloadAlert(object):
     def __init__(self, body, action_loc_key=None, loc_key=None,
@@ -263,9 +824,19 @@ class PayloadAlert(object):
         return d
 
 class Payload(object):
-    """A class representing an APNs message payload"""
-    def __init__(self, alert=None, badge=None, sound=None, content_available=True, custom={}):
+    """
+    A class representing an APNs message payload
+
+    A frozen payload encodes its JSON once and returns the cached string
+    from json() until one of its attributes is assigned again. Changes made
+    in place, such as to the custom dict or to a PayloadAlert, aren't
+    noticed, so a frozen payload shouldn't be modified that way.
+    """
+    def __init__(self, alert=None, badge=None, sound=None, content_available=True, custom={},
+                 frozen=False):
         super(Payload, self).__init__()
+        self._json = None
+        self.frozen = frozen
         self.alert = alert
         self.badge = badge
         self.sound = sound
@@ -295,8 +866,19 @@ class Payload(object):
         d.update(self.custom)
         return d
 
+    def __setattr__(self, name, value):
+        super(Payload, self).__setattr__(name, value)
+        if name != '_json':
+            super(Payload, self).__setattr__('_json', None)
+
     def json(self):
-        return json.dumps(self.dict(), separators=(',',':'), ensure_ascii=False).encode('utf-8')
+        if self._json is not None:
+            return self._json
+        payload_json = json.dumps(self.dict(), separators=(',',':'),
+                                  ensure_ascii=False).encode('utf-8')
+        if self.frozen:
+            self._json = payload_json
+        return payload_json
 
     def _check_size(self):
         if len(self.json()) > MAX_PAYLOAD_LENGTH:
@@ -308,33 +890,81 @@ class Payload(object):
         return "%s(%s)" % (self.__class__.__name__, args)
 
 
+class FeedbackBatch(object):
+    """
+    Feedback records in columnar form: tokens holds the binary tokens back
+    to back, TOKEN_LENGTH bytes each, and fail_times an array of the
+    matching fail times as unix timestamps
+    """
+    def __init__(self):
+        super(FeedbackBatch, self).__init__()
+        self.tokens = bytearray()
+        self.fail_times = array('I')
+
+    def __len__(self):
+        return len(self.fail_times)
+
+    def _append(self, buff, start, end, fail_time_unix):
+        if end - start != TOKEN_LENGTH:
+            raise ValueError('Unexpected token length: %d' % (end - start))
+        self.tokens += buff[start:end]
+        self.fail_times.append(fail_time_unix)
+
+    def tokens_hex(self):
+        """Returns the tokens as a list of hex strings"""
+        tokens_hex = b2a_hex(self.tokens)
+        step = 2 * TOKEN_LENGTH
+        return [tokens_hex[i:i + step] for i in xrange(0, len(tokens_hex), step)]
+
+    def token_set(self):
+        """Returns the tokens as a TokenSet"""
+        tokens = str(self.tokens)
+        return TokenSet(tokens[i:i + TOKEN_LENGTH]
+                        for i in xrange(0, len(tokens), TOKEN_LENGTH))
+
+
 class FeedbackConnection(APNsConnection):
     """
     A class representing a connection to the APNs Feedback server
     """
     def __init__(self, use_sandbox=False, **kwargs):
         super(FeedbackConnection, self).__init__(**kwargs)
+        self.use_sandbox = use_sandbox
         self.server = (
             'feedback.push.apple.com',
             'feedback.sandbox.push.apple.com')[use_sandbox]
         self.port = 2196
 
+    record_header = Struct('>IH')   # fail time, token length
+
     def _chunks(self):
-        BUF_SIZE = 4096
+        """
+        A generator that reads the feedback into a reusable buffer and
+        yields views of the data read, each valid until the next one is
+        requested. The last one is empty.
+        """
+        buff = bytearray(FEEDBACK_BUFFER_SIZE)
+        view = memoryview(buff)
         while 1:
-            data = self.read(BUF_SIZE)
-            yield data
-            if not data:
+            n = self._connection().recv_into(buff)
+            yield view[:n]
+            if not n:
                 break
 
-    def items(self):
+    def _records(self):
         """
-        A generator that yields (token_hex, fail_time) pairs retrieved from
-        the APNs feedback server
+        A generator that yields (buff, start, end, fail_time_unix) for each
+        feedback record, where buff[start:end] is the binary token. buff is
+        reused, so the token has to be copied before the next record is
+        requested.
         """
-        buff = ''
+        header = self.record_header
+        header_size = header.size
+        metrics = self.metrics
+        records = 0
+        buff = bytearray()
         for chunk in self._chunks():
-            buff += chunk
+            buff[len(buff):] = chunk
 
             # Quit if there's no more data to read
             if not buff:
@@ -342,76 +972,1048 @@ class FeedbackConnection(APNsConnection):
 
             # Sanity check: after a socket read we should always have at least
             # 6 bytes in the buffer
-            if len(buff) < 6:
+            if len(buff) < header_size:
                 break
 
-            while len(buff) > 6:
-                token_length = APNs.unpacked_ushort_big_endian(buff[4:6])
-                bytes_to_read = 6 + token_length
-                if len(buff) >= bytes_to_read:
-                    fail_time_unix = APNs.unpacked_uint_big_endian(buff[0:4])
-                    fail_time = datetime.utcfromtimestamp(fail_time_unix)
-                    token = b2a_hex(buff[6:bytes_to_read])
+            offset = 0
+            length = len(buff)
+            while length - offset > header_size:
+                fail_time_unix, token_length = header.unpack_from(buff, offset)
+                end = offset + header_size + token_length
+                if end > length:
+                    # go and fetch some more data and append to buffer
+                    break
+                yield (buff, offset + header_size, end, fail_time_unix)
+                offset = end
+                records += 1
+            if metrics.enabled and records:
+                metrics.count('feedback.items', records)
+                records = 0
+            # Drop the records parsed, leaving at most one partial record
+            del buff[:offset]
+
+    def items(self, raw=False):
+        """
+        A generator that yields (token_hex, fail_time) pairs retrieved from
+        the APNs feedback server, where fail_time is a UTC datetime. With
+        raw=True it yields (token_bin, fail_time_unix) pairs instead, with the
+        binary token and the fail time as a unix timestamp.
+        """
+        if raw:
+            for buff, start, end, fail_time_unix in self._records():
+                yield (str(buff[start:end]), fail_time_unix)
+        else:
+            for buff, start, end, fail_time_unix in self._records():
+                yield (b2a_hex(buff[start:end]),
+                       datetime.utcfromtimestamp(fail_time_unix))
 
-                    yield (token, fail_time)
+    def items_batch(self, max_items=FEEDBACK_BATCH_SIZE):
+        """
+        A generator that yields the feedback as FeedbackBatch objects of up
+        to max_items records each
+        """
+        batch = FeedbackBatch()
+        for buff, start, end, fail_time_unix in self._records():
+            batch._append(buff, start, end, fail_time_unix)
+            if len(batch) >= max_items:
+                yield batch
+                batch = FeedbackBatch()
+        if len(batch):
+            yield batch
+
+    def fetch_all(self):
+        """Returns all of the feedback as a single FeedbackBatch"""
+        batch = FeedbackBatch()
+        tokens = batch.tokens
+        append_fail_time = batch.fail_times.append
+        for buff, start, end, fail_time_unix in self._records():
+            if end - start != TOKEN_LENGTH:
+                raise ValueError('Unexpected token length: %d' % (end - start))
+            tokens += buff[start:end]
+            append_fail_time(fail_time_unix)
+        return batch
+
+class FrameEncoder(object):
+    """
+    Collects notification frames in the simple (command 0) and enhanced
+    (command 1) formats and joins them when they are written. The fixed-size
+    fields and the token of a frame are packed in one call by a precompiled
+    struct per token length.
+    """
+    simple_header = Struct('>BH')       # command, token length
+    enhanced_header = Struct('>BIIH')   # command, identifier, expiry, token length
+    payload_header = Struct('>H')       # payload length
+    identifier_field = Struct('>I')     # identifier, at offset 1 of enhanced frames
+    # token length -> Struct of the header, token and payload length
+    _simple_structs = {}
+    _enhanced_structs = {}
+
+    def __init__(self):
+        super(FrameEncoder, self).__init__()
+        self._chunks = []
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    @classmethod
+    def _frame_struct(cls, structs, header, token_length):
+        frame = structs.get(token_length)
+        if frame is None:
+            frame = structs[token_length] = Struct('%s%dsH' % (header.format, token_length))
+        return frame
+
+    def append_simple(self, token_bin, payload_json):
+        """
+        Appends a frame in the simple format for a binary token and an
+        already encoded payload
+        """
+        frame = self._simple_structs.get(len(token_bin))
+        if frame is None:
+            frame = self._frame_struct(self._simple_structs, self.simple_header,
+                                       len(token_bin))
+        data = frame.pack(0, len(token_bin), token_bin, len(payload_json)) + payload_json
+        self._chunks.append(data)
+        self._length += len(data)
+
+    def append_enhanced(self, token_bin, payload_json, identifier, expiry):
+        """
+        Appends a frame in the enhanced format for a binary token, an already
+        encoded payload and an expiry given as a unix timestamp
+        """
+        frame = self._enhanced_structs.get(len(token_bin))
+        if frame is None:
+            frame = self._frame_struct(self._enhanced_structs, self.enhanced_header,
+                                       len(token_bin))
+        data = (frame.pack(1, identifier, expiry, len(token_bin), token_bin, len(payload_json))
+                + payload_json)
+        self._chunks.append(data)
+        self._length += len(data)
+
+    @classmethod
+    def pack_simple(cls, token_bin, payload_json):
+        """Returns a single frame in the simple format as a string"""
+        frame = cls._frame_struct(cls._simple_structs, cls.simple_header, len(token_bin))
+        return frame.pack(0, len(token_bin), token_bin, len(payload_json)) + payload_json
+
+    @classmethod
+    def pack_enhanced(cls, token_bin, payload_json, identifier, expiry):
+        """Returns a single frame in the enhanced format as a string"""
+        frame = cls._frame_struct(cls._enhanced_structs, cls.enhanced_header, len(token_bin))
+        return (frame.pack(1, identifier, expiry, len(token_bin), token_bin, len(payload_json))
+                + payload_json)
+
+    def getvalue(self):
+        """Returns the frames encoded since the last clear() as a string"""
+        return ''.join(self._chunks)
+
+    def clear(self):
+        self._chunks = []
+        self._length = 0
+
+
+def expiry_timestamp(expiry):
+    """
+    Returns an expiry given as a datetime or a number as an int unix timestamp
+    """
+    if isinstance(expiry, datetime):
+        return int(mktime(expiry.timetuple()))
+    return int(expiry)
+
+
+class TokenSet(object):
+    """
+    A set of device tokens kept in binary form, TOKEN_LENGTH bytes each,
+    in one contiguous bytearray, with an open addressing hash table of slot
+    numbers for O(1) membership tests and removal. Tokens can be given as
+    hex strings or in binary as strings, bytearrays or memoryviews, such as
+    those iter_binary() yields. A TokenSet can be passed to
+    GatewayConnection.broadcast, which then uses the binary tokens as they
+    are. Don't change the set while iterating over it.
+    """
+    _hash = Struct('=Q')
+    _EMPTY = 0
+    _REMOVED = -1
+
+    def __init__(self, tokens=()):
+        super(TokenSet, self).__init__()
+        self._buffer = bytearray()
+        self._alive = bytearray()
+        self._free = []
+        self._index = array('i', [self._EMPTY]) * 16
+        self._filled = 0     # index entries that aren't empty
+        self._length = 0
+        self.update(tokens)
+
+    def __len__(self):
+        return self._length
+
+    @staticmethod
+    def _binary(token):
+        if len(token) == 2 * TOKEN_LENGTH:
+            return a2b_hex(token)
+        if len(token) != TOKEN_LENGTH:
+            raise ValueError('Invalid token %r' % (token,))
+        if type(token) is not str:
+            # str() of a memoryview would be its repr
+            token = bytes(bytearray(token))
+        assert len(token) == TOKEN_LENGTH
+        return token
+
+    def _find(self, token_bin):
+        """
+        Returns the index position holding token_bin, or the position it
+        should be stored at if it isn't in the set
+        """
+        index = self._index
+        mask = len(index) - 1
+        position = self._hash.unpack_from(token_bin)[0] & mask
+        free = None
+        while True:
+            slot = index[position]
+            if slot == self._EMPTY:
+                return position if free is None else free
+            if slot == self._REMOVED:
+                if free is None:
+                    free = position
+            else:
+                offset = (slot - 1) * TOKEN_LENGTH
+                if self._buffer[offset:offset + TOKEN_LENGTH] == token_bin:
+                    return position
+            position = (position + 1) & mask
+
+    def _resize(self, size):
+        self._index = array('i', [self._EMPTY]) * size
+        self._filled = 0
+        for slot in xrange(len(self._alive)):
+            if self._alive[slot]:
+                offset = slot * TOKEN_LENGTH
+                position = self._find(str(self._buffer[offset:offset + TOKEN_LENGTH]))
+                self._index[position] = slot + 1
+                self._filled += 1
+
+    def _add(self, token_bin):
+        position = self._find(token_bin)
+        if self._index[position] > 0:
+            return
+        if self._index[position] == self._EMPTY:
+            self._filled += 1
+        if self._free:
+            slot = self._free.pop()
+            offset = slot * TOKEN_LENGTH
+            self._buffer[offset:offset + TOKEN_LENGTH] = token_bin
+            self._alive[slot] = 1
+        else:
+            slot = len(self._alive)
+            self._buffer.extend(token_bin)
+            self._alive.append(1)
+        self._index[position] = slot + 1
+        self._length += 1
+        if 3 * self._filled > 2 * len(self._index):
+            self._resize(2 * len(self._index) if 3 * self._length > len(self._index)
+                         else len(self._index))
+
+    def add(self, token):
+        self._add(self._binary(token))
+
+    def update(self, tokens):
+        """Adds an iterable of hex or binary tokens"""
+        for token in tokens:
+            self._add(self._binary(token))
+
+    def update_hex(self, tokens_hex):
+        """
+        Adds a list of hex tokens, decoding all of them with a single
+        a2b_hex call. Returns the tokens that aren't 2 * TOKEN_LENGTH hex
+        digits, which are left out.
+        """
+        tokens_hex = list(tokens_hex)
+        data = None
+        if set(map(len, tokens_hex)) <= set([2 * TOKEN_LENGTH]):
+            try:
+                data = a2b_hex(''.join(tokens_hex))
+            except TypeError:
+                pass
+        if data is None:
+            invalid = []
+            for token_hex in tokens_hex:
+                try:
+                    if len(token_hex) != 2 * TOKEN_LENGTH:
+                        raise ValueError('Invalid token %r' % (token_hex,))
+                    self._add(a2b_hex(token_hex))
+                except (TypeError, ValueError):
+                    invalid.append(token_hex)
+            return invalid
+        for offset in xrange(0, len(data), TOKEN_LENGTH):
+            self._add(data[offset:offset + TOKEN_LENGTH])
+        return []
+
+    def __contains__(self, token):
+        try:
+            token_bin = self._binary(token)
+        except (TypeError, ValueError):
+            return False
+        return self._index[self._find(token_bin)] > 0
+
+    def discard(self, token):
+        try:
+            token_bin = self._binary(token)
+        except (TypeError, ValueError):
+            return
+        position = self._find(token_bin)
+        slot = self._index[position] - 1
+        if slot < 0:
+            return
+        self._index[position] = self._REMOVED
+        self._alive[slot] = 0
+        self._free.append(slot)
+        self._length -= 1
+
+    def iter_binary(self):
+        """Yields the tokens as read-only binary views into the set's buffer"""
+        view = memoryview(self._buffer)
+        alive = self._alive
+        for slot in xrange(len(alive)):
+            if alive[slot]:
+                offset = slot * TOKEN_LENGTH
+                yield view[offset:offset + TOKEN_LENGTH]
+
+    def __iter__(self):
+        """Yields the tokens as hex strings"""
+        for token_bin in self.iter_binary():
+            yield b2a_hex(token_bin.tobytes())
+
+    def as_array(self):
+        """
+        Returns a NumPy uint8 array of shape (slots, TOKEN_LENGTH) sharing
+        the set's buffer. Rows of removed tokens are included; see
+        alive_array(). No tokens can be added while the array exists.
+        Requires NumPy.
+        """
+        assert numpy is not None, 'as_array requires NumPy'
+        return numpy.frombuffer(self._buffer, dtype=numpy.uint8).reshape(-1, TOKEN_LENGTH)
+
+    def alive_array(self):
+        """Returns a NumPy bool array telling which rows of as_array() are in the set"""
+        assert numpy is not None, 'alive_array requires NumPy'
+        return numpy.frombuffer(self._alive, dtype=numpy.bool_)
+
+
+class TokenBucket(object):
+    """
+    Paces notifications to rate per second, allowing bursts of up to burst
+    notifications. The rate adapts to the APNs: back_off() multiplies it by
+    BACKOFF_FACTOR, down to min_rate, and it then grows back by increase
+    per second, up to the rate it was created with. One bucket can be
+    shared by several connections to pace them together.
+    """
+    def __init__(self, rate, burst=None, min_rate=1.0, increase=None):
+        super(TokenBucket, self).__init__()
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.burst = burst or self.max_rate
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.increase = self.max_rate / 60 if increase is None else increase
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._lock = Lock()
+
+    def reserve(self, n=1):
+        """
+        Takes n tokens and returns the number of seconds to wait before
+        they may be used. The tokens are taken even if they aren't there
+        yet, so callers are served in order.
+        """
+        with self._lock:
+            now = time.time()
+            elapsed = now - self._updated
+            self._updated = now
+            self.rate = min(self.max_rate, self.rate + self.increase * elapsed)
+            self._tokens = min(self.burst, self._tokens + self.rate * elapsed) - n
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def back_off(self):
+        """Lowers the rate and drops the saved up burst"""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * BACKOFF_FACTOR)
+            self._tokens = min(self._tokens, 0.0)
 
-                    # Remove data for current token from buffer
-                    buff = buff[bytes_to_read:]
-                else:
-                    # break out of inner while loop - i.e. go and fetch
-                    # some more data and append to buffer
-                    break
 
 class GatewayConnection(APNsConnection):
     """
     A class that represents a connection to the APNs gateway server
+
+    In enhanced mode with a non-zero resend_window the connection keeps the
+    last resend_window frames it has written. When the APNs answers with an
+    error response it reconnects, passes the error and the token of the
+    rejected notification to error_callback and resends the frames that
+    were written after it, so APNResponseError is only raised when the
+    notification the error refers to has already left the window. As the
+    window is searched by identifier, the identifiers of the notifications
+    in it must be unique: writing one that is already there raises
+    ValueError. With an
+    ErrorResponseReader error_callback is called from the reader as soon as
+    the error response arrives, with None for the token if the notification
+    isn't in the window, so that errors for the last notifications sent are
+    reported without waiting for another write. The error is still raised
+    or handled by the next write, but not passed to error_callback again.
+
+    pacing is a TokenBucket, or a list of them (e.g. one for this connection
+    and one shared by all connections), that every notification waits for.
+    ShutdownError, socket errors and timeouts make them back off.
+
+    With keep_alive set a ConnectionKeeper opens the connection right away
+    and keeps it open, reconnecting after idle_ttl seconds without a write.
     """
-    def __init__(self, use_sandbox=False, **kwargs):
+    def __init__(self, use_sandbox=False, resend_window=0, error_callback=None,
+                 pacing=None, keep_alive=False, idle_ttl=IDLE_TTL, **kwargs):
         super(GatewayConnection, self).__init__(**kwargs)
+        self.use_sandbox = use_sandbox
         self.server = (
             'gateway.push.apple.com',
             'gateway.sandbox.push.apple.com')[use_sandbox]
         self.port = 2195
+        self.error_callback = error_callback
+        if isinstance(pacing, TokenBucket):
+            pacing = [pacing]
+        self.pacing = list(pacing or ())
+        self._sent = None
+        if self.enhanced and resend_window:
+            # (identifier, data, start, end) for each frame written, and
+            # their identifiers
+            self._sent = deque(maxlen=resend_window)
+            self._sent_identifiers = set()
+        if keep_alive:
+            self.keep_alive(idle_ttl=idle_ttl)
+
+    def keep_alive(self, interval=KEEPER_INTERVAL, idle_ttl=IDLE_TTL):
+        """Starts a ConnectionKeeper for this connection and returns it"""
+        keeper = ConnectionKeeper(self, interval, idle_ttl)
+        keeper.start()
+        return keeper
+
+    @property
+    def rate(self):
+        """The rate notifications are currently paced to, or None"""
+        if self.pacing:
+            return min(bucket.rate for bucket in self.pacing)
+
+    def _pace(self, n):
+        if self.pacing:
+            delay = max([bucket.reserve(n) for bucket in self.pacing])
+            if delay:
+                time.sleep(delay)
+
+    def _back_off(self):
+        for bucket in self.pacing:
+            bucket.back_off()
+
+    def _payload_json(self, payload):
+        if self.metrics.enabled:
+            started = time.time()
+            payload_json = payload.json()
+            self.metrics.timing('encode.json', time.time() - started)
+            return payload_json
+        return payload.json()
 
     def _get_notification(self, token_hex, payload):
         """
         Takes a token as a hex string and a payload as a Python dict and sends
         the notification
         """
-        token_bin = a2b_hex(token_hex)
-        token_length_bin = APNs.packed_ushort_big_endian(len(token_bin))
-        payload_json = payload.json()
-        payload_length_bin = APNs.packed_ushort_big_endian(len(payload_json))
-
-        notification = ('\0' + token_length_bin + token_bin
-                        + payload_length_bin + payload_json)
-
-        return notification
+        return FrameEncoder.pack_simple(a2b_hex(token_hex), self._payload_json(payload))
 
     def _get_enhanced_notification(self, token_hex, payload, identifier, expiry):
         """
         Takes a token as a hex string and a payload as a Python dict and sends
         the notification in the enhanced format
         """
-        token_bin = a2b_hex(token_hex)
-        token_length_bin = APNs.packed_ushort_big_endian(len(token_bin))
-        payload_json = payload.json()
-        payload_length_bin = APNs.packed_ushort_big_endian(len(payload_json))
-        identifier_bin = APNs.packed_uint_big_endian(identifier)
+        return FrameEncoder.pack_enhanced(a2b_hex(token_hex), self._payload_json(payload),
+                                          identifier, expiry_timestamp(expiry))
 
-        expiry_int = int(mktime(expiry.timetuple())) if isinstance(expiry, datetime) \
-            else int(expiry)
-            
-        expiry_bin = APNs.packed_uint_big_endian(expiry_int)
+    def _append_frame(self, encoder, token_hex, payload, identifier=0, expiry=0):
+        if self.enhanced:
+            encoder.append_enhanced(a2b_hex(token_hex), self._payload_json(payload),
+                                    identifier, expiry_timestamp(expiry))
+        else:
+            encoder.append_simple(a2b_hex(token_hex), self._payload_json(payload))
+        return identifier
+
+    def _write_frames(self, data, frames):
+        """
+        Writes data holding the enhanced frames given as (identifier, start,
+        end) and keeps them in the resend window, resending after error
+        responses as described in the class docstring
+        """
+        try:
+            if self._sent is None:
+                return self.write(data)
+            while True:
+                try:
+                    with self._lock:
+                        self._check_identifiers(frames)
+                        self.write(data)
+                        for identifier, start, end in frames:
+                            self._keep(identifier, data, start, end)
+                except APNResponseError, err:
+                    # raised again if it can't be handled, and backed off below
+                    data, frames = self._frames_to_resend(err, data, frames)
+                    if isinstance(err, ShutdownError):
+                        self._back_off()
+                    continue
+                return
+        except (ShutdownError, socket_error, timeout):
+            self._back_off()
+            raise
 
-        notification = ('\1' + identifier_bin + expiry_bin + token_length_bin + token_bin
-                        + payload_length_bin + payload_json)
+    def _check_identifiers(self, frames):
+        """Raises ValueError unless the identifiers of frames are new to the window"""
+        identifiers = set()
+        for identifier, _, _ in frames:
+            if identifier in identifiers or identifier in self._sent_identifiers:
+                raise ValueError('identifier %d is already in the resend window' % identifier)
+            identifiers.add(identifier)
+
+    def _keep(self, identifier, data, start, end):
+        """Adds a written frame to the window, dropping the oldest if it's full"""
+        sent = self._sent
+        if len(sent) == sent.maxlen:
+            self._sent_identifiers.discard(sent[0][0])
+        sent.append((identifier, data, start, end))
+        self._sent_identifiers.add(identifier)
+
+    @staticmethod
+    def _frame_token(data, start):
+        """Returns the hex token of the enhanced frame at start of data"""
+        token_length = FrameEncoder.enhanced_header.unpack_from(data, start)[3]
+        token_start = start + FrameEncoder.enhanced_header.size
+        return b2a_hex(data[token_start:token_start + token_length])
+
+    def _report_error_response(self, err):
+        if self.error_callback is None or isinstance(err, ShutdownError):
+            return
+        token_hex = None
+        # a copy, as the writing thread may be appending
+        for identifier, data, start, _ in reversed(list(self._sent or ())):
+            if identifier == err.identifier:
+                token_hex = self._frame_token(data, start)
+                break
+        self.error_callback(err, token_hex)
+
+    def _frames_to_resend(self, err, data, frames):
+        """
+        Handles an error response received before data could be written.
+        Returns the frames written after the one err refers to followed by
+        the unwritten ones, joined as (data, frames)
+        """
+        sent = list(self._sent)
+        self._sent.clear()
+        self._sent_identifiers.clear()
+        for i in range(len(sent) - 1, -1, -1):
+            if sent[i][0] == err.identifier:
+                break
+        else:
+            raise err
+
+        if not isinstance(err, ShutdownError) and self.error_callback and err is not self._reported:
+            # for any other status the identifier is the rejected notification's
+            _, bad_data, start, _ = sent[i]
+            self.error_callback(err, self._frame_token(bad_data, start))
+
+        chunks = []
+        resend = []
+        offset = 0
+        for identifier, frame_data, start, end in sent[i + 1:]:
+            chunks.append(frame_data[start:end])
+            resend.append((identifier, offset, offset + end - start))
+            offset += end - start
+        chunks.append(data)
+        resend.extend((identifier, start + offset, end + offset)
+                      for identifier, start, end in frames)
+        return ''.join(chunks), resend
 
-        return notification
-    
     def send_notification(self, token_hex, payload, identifier=0, expiry=0):
+        self._pace(1)
+        if self.metrics.enabled:
+            self.metrics.count('write.frames')
         if self.enhanced:
-            self.write(self._get_enhanced_notification(token_hex, payload, identifier,
-                                                       expiry))
+            frame = self._get_enhanced_notification(token_hex, payload, identifier, expiry)
+            self._write_frames(frame, [(identifier, 0, len(frame))])
+        else:
+            self._write_frames(self._get_notification(token_hex, payload), ())
+
+    def send_notifications(self, notifications, flush_size=FLUSH_SIZE,
+                           flush_interval=FLUSH_INTERVAL):
+        """
+        Takes an iterable of (token_hex, payload[, identifier[, expiry]])
+        tuples and sends them, coalescing the encoded frames into a buffer
+        that is written out once it holds flush_size bytes or flush_interval
+        seconds have passed since the last write. In enhanced mode every
+        write first checks for an error response, so an APNResponseError is
+        raised as with send_notification.
+        """
+        self._write_encoded(notifications, self._append_frame, flush_size, flush_interval)
+
+    def broadcast(self, tokens, payload, expiry=0, start_identifier=0,
+                  flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL):
+        """
+        Sends payload to each of an iterable of hex tokens, numbering the
+        notifications from start_identifier, and returns the identifier
+        following the last one used. The payload is encoded to JSON only
+        once. Frames are written as by send_notifications. tokens may also
+        be a TokenSet, whose binary tokens are used without hex decoding.
+        """
+        payload_json = payload.json()
+        expiry = expiry_timestamp(expiry)
+        next_identifier = [start_identifier]
+
+        if isinstance(tokens, TokenSet):
+            tokens, to_binary = tokens.iter_binary(), memoryview.tobytes
+        else:
+            to_binary = a2b_hex
+
+        def append(encoder, identifier, token):
+            token_bin = to_binary(token)
+            if self.enhanced:
+                encoder.append_enhanced(token_bin, payload_json, identifier, expiry)
+            else:
+                encoder.append_simple(token_bin, payload_json)
+            next_identifier[0] = identifier + 1
+            return identifier
+
+        self._write_encoded(enumerate(tokens, start_identifier), append, flush_size,
+                            flush_interval)
+        return next_identifier[0]
+
+    def _write_encoded(self, items, append, flush_size, flush_interval):
+        """
+        Calls append(encoder, *item) for each item, which encodes a frame and
+        returns its identifier, and writes the frames out in batches, each
+        paced as a whole
+        """
+        encoder = FrameEncoder()
+        frames = []
+        pending = 0
+        last_flush = time.time()
+        for item in items:
+            start = len(encoder)
+            identifier = append(encoder, *item)
+            pending += 1
+            if self._sent is not None:
+                frames.append((identifier, start, len(encoder)))
+            if len(encoder) >= flush_size or time.time() - last_flush >= flush_interval:
+                self._flush(encoder, frames, pending, last_flush)
+                frames = []
+                pending = 0
+                last_flush = time.time()
+        if len(encoder):
+            self._flush(encoder, frames, pending, last_flush)
+
+    def _flush(self, encoder, frames, pending, started):
+        """Writes the pending frames of encoder, which were encoded since started"""
+        if self.metrics.enabled:
+            self.metrics.timing('encode.batch', time.time() - started)
+            self.metrics.count('write.frames', pending)
+            self.metrics.observe('flush.bytes', len(encoder))
+        self._pace(pending)
+        self._write_frames(encoder.getvalue(), frames)
+        encoder.clear()
+
+
+class GatewayConnectionPool(object):
+    """
+    A fixed number of gateway connections sharing the notifications of one
+    certificate. Each connection is used by one thread at a time.
+
+    With dispatch='round_robin' a notification goes to the next connection
+    that isn't busy; with dispatch='token' all notifications for a token go
+    to the same connection, so they are delivered in order. A connection
+    whose socket fails is replaced and the notification is sent again on
+    the new one.
+
+    In enhanced mode every connection keeps a resend window of
+    resend_window frames, POOL_RESEND_WINDOW unless one is given, so an
+    error response is handled by the connection it arrives on as described
+    for GatewayConnection: the rejected token is passed to error_callback
+    and the notifications the APNs dropped after it are resent. Only errors
+    for notifications that have left the window are raised, by the
+    connection they were sent on, which reconnects on its next use.
+    Notifications sent without an identifier are numbered by the pool, so
+    the identifiers in each window are unique.
+
+    With connection_rate set each connection is paced by a TokenBucket of its
+    own, in addition to any pacing buckets, which are shared by all of them.
+    """
+    def __init__(self, size, dispatch='round_robin', connection_rate=None, **kwargs):
+        super(GatewayConnectionPool, self).__init__()
+        assert size > 0
+        assert dispatch in ('round_robin', 'token')
+        self.dispatch = dispatch
+        self.connection_rate = connection_rate
+        if kwargs.get('enhanced') and not kwargs.get('resend_window'):
+            kwargs['resend_window'] = POOL_RESEND_WINDOW
+        self._kwargs = kwargs
+        self.connections = [self._new_connection() for i in range(size)]
+        self._locks = [Lock() for i in range(size)]
+        self._counter = count()
+        self._identifiers = count()
+
+    def __len__(self):
+        return len(self.connections)
+
+    def _acquire(self, token_hex):
+        """Picks and locks a connection, returning its index"""
+        size = len(self.connections)
+        if self.dispatch == 'token':
+            index = int(token_hex[:8], 16) % size
         else:
-            self.write(self._get_notification(token_hex, payload))
+            index = next(self._counter) % size
+            for i in range(size):
+                if self._locks[(index + i) % size].acquire(False):
+                    return (index + i) % size
+        self._locks[index].acquire()
+        return index
+
+    def _new_connection(self):
+        connection = GatewayConnection(**self._kwargs)
+        if self.connection_rate:
+            connection.pacing.insert(0, TokenBucket(self.connection_rate))
+        return connection
+
+    def _replace(self, index):
+        connection = self.connections[index]
+        connection._disconnect()
+        self.connections[index] = GatewayConnection(**self._kwargs)
+        # the new connection keeps the old one's, possibly backed off, buckets
+        self.connections[index].pacing = connection.pacing
+
+    def _next_identifier(self):
+        return next(self._identifiers) & MAX_IDENTIFIER
+
+    def _numbered(self, notifications):
+        """Gives the notifications without an identifier one of the pool's"""
+        for notification in notifications:
+            if len(notification) < 3:
+                notification = tuple(notification) + (self._next_identifier(),)
+            yield notification
+
+    def send_notification(self, token_hex, payload, identifier=None, expiry=0):
+        if identifier is None:
+            identifier = self._next_identifier()
+        index = self._acquire(token_hex)
+        try:
+            try:
+                self.connections[index].send_notification(token_hex, payload, identifier,
+                                                          expiry)
+            except (socket_error, timeout):
+                self._replace(index)
+                self.connections[index].send_notification(token_hex, payload, identifier,
+                                                          expiry)
+        finally:
+            self._locks[index].release()
+
+    def send_notifications(self, notifications, **kwargs):
+        """
+        Sends an iterable of notifications as GatewayConnection's
+        send_notifications does, on a single connection of the pool. Call it
+        from several threads to use several connections at once. A
+        connection whose socket fails is replaced, but as part of the
+        notifications may already have been sent the error is raised.
+        """
+        notifications = self._numbered(notifications)
+        for first in notifications:
+            # the connection is picked using the first token
+            index = self._acquire(first[0])
+            try:
+                self.connections[index].send_notifications(chain([first], notifications),
+                                                           **kwargs)
+            except (socket_error, timeout):
+                self._replace(index)
+                raise
+            finally:
+                self._locks[index].release()
+            break
+
+    def close(self):
+        for index in range(len(self.connections)):
+            with self._locks[index]:
+                self.connections[index]._disconnect()
+
+
+class GatewayMultiplexer(object):
+    """
+    Drives several enhanced gateway connections from a single thread.
+    send_notification() only queues the encoded frame for a connection;
+    poll() waits on all the sockets with one select call, writes whatever
+    each socket accepts and picks up error responses, which are passed to
+    error_callback as (connection, err). The connection is then reopened
+    for its remaining queued frames, starting with the frame that was only
+    partly written, if any. Frames the APNs discarded after the rejected
+    one are not resent.
+    """
+    def __init__(self, connections, high_water=4 * FLUSH_SIZE, error_callback=None):
+        super(GatewayMultiplexer, self).__init__()
+        self.connections = list(connections)
+        for connection in self.connections:
+            assert connection.enhanced
+        self.high_water = high_water
+        self.error_callback = error_callback
+        self._pending = dict((connection, FrameEncoder()) for connection in self.connections)
+        # the ends of the frames queued in _pending
+        self._pending_ends = dict((connection, []) for connection in self.connections)
+        # the frames being written, joined, the ends of the frames and how
+        # much of them has been written
+        self._writing = dict((connection, '') for connection in self.connections)
+        self._writing_ends = dict((connection, []) for connection in self.connections)
+        self._offsets = dict((connection, 0) for connection in self.connections)
+
+    def pending(self, connection=None):
+        """
+        Returns the number of queued bytes not yet written for a connection,
+        or for all connections
+        """
+        if connection is not None:
+            return (len(self._pending[connection]) + len(self._writing[connection])
+                    - self._offsets[connection])
+        return sum(self.pending(c) for c in self.connections)
+
+    def send_notification(self, connection, token_hex, payload, identifier=0, expiry=0):
+        """
+        Queues a notification on one of the connections. Returns False once
+        more than high_water bytes are queued for it, in which case the
+        caller should poll() or drain() before queueing more.
+        """
+        encoder = self._pending[connection]
+        connection._append_frame(encoder, token_hex, payload, identifier, expiry)
+        self._pending_ends[connection].append(len(encoder))
+        return self.pending(connection) <= self.high_water
+
+    def _write(self, connection):
+        data = self._writing[connection]
+        offset = self._offsets[connection]
+        if offset == len(data):
+            encoder = self._pending[connection]
+            data = self._writing[connection] = encoder.getvalue()
+            self._writing_ends[connection] = self._pending_ends[connection]
+            self._pending_ends[connection] = []
+            encoder.clear()
+            offset = 0
+        try:
+            offset += connection._ssl.send(memoryview(data)[offset:offset + FLUSH_SIZE])
+        except SSLError, err:
+            if err.args[0] not in (SSL_ERROR_WANT_READ, SSL_ERROR_WANT_WRITE):
+                raise
+        self._offsets[connection] = offset
+
+    def _read(self, connection):
+        try:
+            err = connection._read_error_response()
+        except SSLError, err:
+            if SSL_ERROR_WANT_READ == err.args[0]:
+                return
+            raise
+        if err is None:
+            connection._disconnect()
+        self._rewind(connection)
+        if err and self.error_callback:
+            self.error_callback(connection, err)
+
+    def _rewind(self, connection):
+        """
+        Moves back to the start of the frame being written once the
+        connection is closed, so that the next one doesn't start mid-frame
+        """
+        ends = self._writing_ends[connection]
+        i = bisect_right(ends, self._offsets[connection])
+        self._offsets[connection] = ends[i - 1] if i else 0
+
+    def poll(self, timeout=0):
+        """
+        Waits up to timeout seconds for any of the sockets to become ready
+        and services the ones that are. Returns the number of sockets that
+        were ready.
+        """
+        for connection in self.connections:
+            if connection._ssl is None and self.pending(connection):
+                connection._connection()
+        by_socket = dict((c._ssl, c) for c in self.connections if c._ssl is not None)
+        if not by_socket:
+            return 0
+        wsockets = [s for s, c in by_socket.items() if self.pending(c)]
+        rlist, wlist, _ = select.select(list(by_socket), wsockets, [], timeout)
+        for ssl_socket in rlist:
+            self._read(by_socket[ssl_socket])
+        for ssl_socket in wlist:
+            connection = by_socket[ssl_socket]
+            if connection._ssl is ssl_socket:
+                self._write(connection)
+        return len(set(rlist) | set(wlist))
+
+    def drain(self, wait=TIMEOUT):
+        """
+        Polls until every queued frame is written. Raises socket.timeout if
+        none of the sockets becomes ready within wait seconds.
+        """
+        while self.pending():
+            if not self.poll(wait):
+                raise timeout
+
+
+def _base64url(data):
+    return urlsafe_b64encode(data).rstrip('=')
+
+
+class ProviderToken(object):
+    """
+    The ES256 JSON web token that authenticates a provider with the HTTP/2
+    provider API in place of a certificate. The token is signed once and
+    reused until it is refresh_interval seconds old, well within the hour
+    the APNs accepts it for. get() only takes a lock to re-sign, and while
+    one thread does so the others keep using the previous token, so one
+    instance can be shared by any number of connections. Requires ecdsa.
+    """
+    def __init__(self, key_file, key_id, team_id,
+                 refresh_interval=PROVIDER_TOKEN_REFRESH_INTERVAL):
+        super(ProviderToken, self).__init__()
+        assert support_provider_token, 'Provider tokens require ecdsa'
+        with open(key_file) as f:
+            self._key = SigningKey.from_pem(f.read())
+        self.key_id = key_id
+        self.team_id = team_id
+        self.refresh_interval = refresh_interval
+        self._current = (None, 0)   # (token, issued at)
+        self._lock = Lock()
+
+    def _sign(self, issued_at):
+        header = _base64url(json.dumps({'alg': 'ES256', 'kid': self.key_id},
+                                       separators=(',',':')))
+        claims = _base64url(json.dumps({'iss': self.team_id, 'iat': issued_at},
+                                       separators=(',',':')))
+        signing_input = '%s.%s' % (header, claims)
+        signature = self._key.sign(signing_input, hashfunc=sha256,
+                                   sigencode=sigencode_string)
+        return '%s.%s' % (signing_input, _base64url(signature))
+
+    def get(self):
+        """Returns the current token, signing a new one when it's due"""
+        token, issued_at = self._current
+        if time.time() - issued_at < self.refresh_interval:
+            return token
+        if not self._lock.acquire(token is None):
+            # another thread is signing the new token
+            return token
+        try:
+            token, issued_at = self._current
+            if time.time() - issued_at >= self.refresh_interval:
+                issued_at = int(time.time())
+                token = self._sign(issued_at)
+                self._current = (token, issued_at)
+            return token
+        finally:
+            self._lock.release()
+
+
+class HTTP2Connection(object):
+    """
+    A connection to the APNs provider API, which takes each notification as
+    an HTTP/2 request and answers it with its own status. Requests are
+    multiplexed over the one connection, with at most max_concurrent_streams
+    of them (or fewer if the server asks for it) waiting for a response.
+    Requires hyper.
+
+    The connection authenticates with the certificate in cert_file and
+    key_file, or, if provider_token is given, with a ProviderToken sent
+    along with every request.
+    """
+    def __init__(self, use_sandbox=False, cert_file=None, key_file=None, topic=None,
+                 max_concurrent_streams=MAX_CONCURRENT_STREAMS, provider_token=None):
+        super(HTTP2Connection, self).__init__()
+        assert support_http2, 'HTTP/2 support requires hyper'
+        self.use_sandbox = use_sandbox
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self.topic = topic
+        self.max_concurrent_streams = max_concurrent_streams
+        self.provider_token = provider_token
+        self.server = (
+            'api.push.apple.com',
+            'api.development.push.apple.com')[use_sandbox]
+        self.port = 443
+        self.secure = True
+        self._http = None
+
+    def __del__(self):
+        self._disconnect()
+
+    def _connect(self):
+        context = None
+        if self.secure and self.provider_token:
+            context = ssl_context(None, None, self.use_sandbox, http2=True)
+        elif self.secure:
+            context = ssl_context(self.cert_file, self.key_file, self.use_sandbox, http2=True)
+        self._http = HTTP20Connection(self.server, self.port, secure=self.secure,
+                                      ssl_context=context)
+        self._http.connect()
+
+    def _disconnect(self):
+        if self._http:
+            self._http.close()
+            self._http = None
+
+    def _connection(self):
+        if not self._http:
+            self._connect()
+        return self._http
+
+    def _stream_limit(self):
+        with self._connection()._conn as conn:
+            return min(self.max_concurrent_streams,
+                       conn.remote_settings.max_concurrent_streams)
+
+    def _request(self, token_hex, payload, expiry=0, priority=None):
+        headers = {}
+        if self.provider_token:
+            headers['authorization'] = 'bearer %s' % self.provider_token.get()
+        if self.topic:
+            headers['apns-topic'] = self.topic
+        if expiry:
+            headers['apns-expiration'] = str(expiry_timestamp(expiry))
+        if priority:
+            headers['apns-priority'] = str(priority)
+        return self._connection().request('POST', '/3/device/%s' % token_hex,
+                                          payload.json(), headers)
+
+    def _response(self, stream_id):
+        response = self._connection().get_response(stream_id)
+        body = response.read()
+        reason = json.loads(body).get('reason') if body else None
+        return response.status, reason
+
+    def send_notification(self, token_hex, payload, identifier=0, expiry=0,
+                          priority=None):
+        """
+        Sends a notification and returns the (status, reason) the APNs
+        answered with, where status is the HTTP status code and reason is
+        None for a 200
+        """
+        return self._response(self._request(token_hex, payload, expiry, priority))
+
+    def send_notifications(self, notifications, priority=None):
+        """
+        A generator that takes an iterable of (token_hex, payload[,
+        identifier[, expiry]]) tuples, sends them over concurrent streams and
+        yields an (identifier, status, reason) triple for each of them, in
+        the order they were given
+        """
+        in_flight = deque()
+        limit = self._stream_limit()
+        for notification in notifications:
+            token_hex, payload, identifier, expiry = (tuple(notification) + (0, 0))[:4]
+            if len(in_flight) >= limit:
+                sent_identifier, stream_id = in_flight.popleft()
+                yield (sent_identifier,) + self._response(stream_id)
+            in_flight.append((identifier,
+                              self._request(token_hex, payload, expiry, priority)))
+        while in_flight:
+            sent_identifier, stream_id = in_flight.popleft()
+            yield (sent_identifier,) + self._response(stream_id)
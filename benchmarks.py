@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Benchmarks for the PyAPNs hot paths and for sending to the local simulator
+servers in simulator.py. Run with:
+
+    $ python benchmarks.py [--json results.json] [--sizes 1000,100000,1000000]
+
+With --json the results are also written as JSON ('-' for stdout), to
+compare them between releases.
+"""
+import json
+import optparse
+import platform
+import sys
+import time
+from binascii import a2b_hex
+from datetime import datetime, timedelta
+from itertools import count
+from socket import timeout
+from timeit import Timer
+
+from apns import *
+from managed_delivery import (PushNotification, AbstractDeviceStore, AbstractPushNotificationStore,
+                              PushNotificationsProvider, SpecificPushNotificationsProvider,
+                              PushNotificationRelay, send)
+from simulator import GatewaySimulator, FeedbackSimulator
+
+TOKEN_HEX = 'b5bb9d8014a0f9b1d61e21e796d78dccdf1352f23cd32812f4850b878ae4944c'
+PAYLOAD = Payload(alert="Hello World!", sound="default", badge=4,
+                  custom={'et': 'LU', 'ep': 'npvskgdhlmcdkfgj'})
+FROZEN_PAYLOAD = Payload(alert="Hello World!", sound="default", badge=4,
+                         custom={'et': 'LU', 'ep': 'npvskgdhlmcdkfgj'}, frozen=True)
+EXPIRY = datetime.utcnow() + timedelta(30)
+NUMBER = 100000
+SIZES = (1000, 100000, 1000000)
+SIMULATED_FRAMES = 20000
+FEEDBACK_RECORDS = 100000
+RECOVERY_POSITIONS = (0.1, 0.5, 0.9)
+SETTLE_TIMEOUT = 60
+
+
+def legacy_enhanced_notification(token_hex, payload, identifier, expiry):
+    """The string concatenation frame encoding used before FrameEncoder"""
+    token_bin = a2b_hex(token_hex)
+    token_length_bin = APNs.packed_ushort_big_endian(len(token_bin))
+    payload_json = payload.json()
+    payload_length_bin = APNs.packed_ushort_big_endian(len(payload_json))
+    identifier_bin = APNs.packed_uint_big_endian(identifier)
+    expiry_bin = APNs.packed_uint_big_endian(expiry_timestamp(expiry))
+    return ('\1' + identifier_bin + expiry_bin + token_length_bin + token_bin
+            + payload_length_bin + payload_json)
+
+
+def bench_frame_encoding():
+    token_bin = a2b_hex(TOKEN_HEX)
+    payload_json = PAYLOAD.json()
+    expiry = expiry_timestamp(EXPIRY)
+    gateway_server = GatewayConnection(enhanced=True)
+    encoder = FrameEncoder()
+
+    assert (legacy_enhanced_notification(TOKEN_HEX, PAYLOAD, 1, EXPIRY)
+            == gateway_server._get_enhanced_notification(TOKEN_HEX, PAYLOAD, 1, EXPIRY))
+
+    def legacy():
+        legacy_enhanced_notification(TOKEN_HEX, PAYLOAD, 1, EXPIRY)
+
+    def connection():
+        gateway_server._get_enhanced_notification(TOKEN_HEX, PAYLOAD, 1, EXPIRY)
+
+    def connection_frozen():
+        gateway_server._get_enhanced_notification(TOKEN_HEX, FROZEN_PAYLOAD, 1, EXPIRY)
+
+    def pack():
+        FrameEncoder.pack_enhanced(token_bin, payload_json, 1, expiry)
+
+    def encoder_only():
+        if len(encoder) > FLUSH_SIZE:
+            encoder.clear()
+        encoder.append_enhanced(token_bin, payload_json, 1, expiry)
+
+    return [('frame encoding: legacy concatenation', legacy),
+            ('frame encoding: GatewayConnection', connection),
+            ('frame encoding: GatewayConnection, frozen payload', connection_frozen),
+            ('frame encoding: FrameEncoder.pack_enhanced', pack),
+            ('frame encoding: FrameEncoder.append_enhanced', encoder_only)]
+
+
+class NullGatewayConnection(GatewayConnection):
+    """A gateway connection that discards what is written to it"""
+    def write(self, string):
+        pass
+
+
+def bench_bulk_sending():
+    gateway_server = NullGatewayConnection(enhanced=True)
+    tokens = [TOKEN_HEX] * 1000
+
+    def send_notification():
+        for identifier, token_hex in enumerate(tokens):
+            gateway_server.send_notification(token_hex, FROZEN_PAYLOAD, identifier, EXPIRY)
+
+    def send_notifications():
+        gateway_server.send_notifications((token_hex, FROZEN_PAYLOAD, identifier, EXPIRY)
+                                          for identifier, token_hex in enumerate(tokens))
+
+    def broadcast():
+        gateway_server.broadcast(tokens, FROZEN_PAYLOAD, EXPIRY)
+
+    return [('1000 frames: send_notification', send_notification),
+            ('1000 frames: send_notifications', send_notifications),
+            ('1000 frames: broadcast', broadcast)]
+
+
+def bench_feedback_parsing(records=100000):
+    record = (APNs.packed_uint_big_endian(1400000000)
+              + APNs.packed_ushort_big_endian(32) + a2b_hex(TOKEN_HEX))
+    data = record * records
+    feedback_server = FeedbackConnection()
+
+    def chunks():
+        for offset in xrange(0, len(data), 4096):
+            yield data[offset:offset + 4096]
+        yield ''
+    feedback_server._chunks = chunks
+
+    def items():
+        for item in feedback_server.items():
+            pass
+
+    def raw_items():
+        for item in feedback_server.items(raw=True):
+            pass
+
+    def fetch_all():
+        feedback_server.fetch_all()
+
+    return [('%d feedback records: items' % records, items),
+            ('%d feedback records: items(raw=True)' % records, raw_items),
+            ('%d feedback records: fetch_all' % records, fetch_all)]
+
+
+def bench_payload():
+    def construct():
+        Payload(alert="Hello World!", sound="default", badge=4,
+                custom={'et': 'LU', 'ep': 'npvskgdhlmcdkfgj'})
+
+    def encode():
+        PAYLOAD.json()
+
+    def encode_frozen():
+        FROZEN_PAYLOAD.json()
+
+    return [('payload: construction', construct),
+            ('payload: json()', encode),
+            ('payload: json(), frozen', encode_frozen)]
+
+
+def run(benchmarks, number=NUMBER):
+    """Times each (name, func) of benchmarks, best of 3, and returns the results"""
+    results = []
+    for name, func in benchmarks:
+        seconds = min(Timer(func).repeat(3, number))
+        results.append(report(name, number / seconds, 'ops/s'))
+    return results
+
+
+def report(name, value, unit):
+    if unit == 's':
+        print '%-50s %12.4f %s' % (name, value, unit)
+    else:
+        print '%-50s %12.0f %s' % (name, value, unit)
+    return {'name': name, 'value': value, 'unit': unit}
+
+
+def settle(simulator, expected, probe=None):
+    """
+    Waits until simulator has received expected notifications. An error
+    response is only noticed on the next write, so if nothing arrives for
+    a while probe() is called to write once more.
+    """
+    deadline = time.time() + SETTLE_TIMEOUT
+    last = (0, time.time())
+    while len(simulator.notifications) < expected:
+        if time.time() > deadline:
+            raise timeout('the simulator received %d of %d notifications'
+                          % (len(simulator.notifications), expected))
+        if len(simulator.notifications) != last[0]:
+            last = (len(simulator.notifications), time.time())
+        elif probe and time.time() - last[1] > 0.05:
+            probe()
+            expected += 1
+            last = (last[0], time.time())
+        time.sleep(0.001)
+
+
+def notifications(n, start=0):
+    return ((TOKEN_HEX, FROZEN_PAYLOAD, identifier, EXPIRY)
+            for identifier in xrange(start, start + n))
+
+
+def bench_simulated_sending(frames=SIMULATED_FRAMES):
+    """Sends frames notifications over TLS to the gateway simulator"""
+    results = []
+    with GatewaySimulator() as simulator:
+        def gateway():
+            return simulator.attach(APNs(enhanced=True).gateway_server)
+
+        latencies = []
+        for i in range(5):
+            del simulator.notifications[:]
+            gateway_server = gateway()
+            started = time.time()
+            gateway_server.send_notification(TOKEN_HEX, FROZEN_PAYLOAD, 0, EXPIRY)
+            settle(simulator, 1)
+            latencies.append(time.time() - started)
+            gateway_server._disconnect()
+        results.append(report('simulator: first send, including handshake',
+                              sorted(latencies)[len(latencies) // 2], 's'))
+
+        def send_notification(gateway_server):
+            for token_hex, payload, identifier, expiry in notifications(frames):
+                gateway_server.send_notification(token_hex, payload, identifier, expiry)
+
+        def send_notifications(gateway_server):
+            gateway_server.send_notifications(notifications(frames))
+
+        def broadcast(gateway_server):
+            gateway_server.broadcast([TOKEN_HEX] * frames, FROZEN_PAYLOAD, EXPIRY)
+
+        for name, func in [('send_notification', send_notification),
+                           ('send_notifications', send_notifications),
+                           ('broadcast', broadcast)]:
+            del simulator.notifications[:]
+            gateway_server = gateway()
+            gateway_server.send_notification(TOKEN_HEX, FROZEN_PAYLOAD, 0, EXPIRY)
+            settle(simulator, 1)
+            started = time.time()
+            func(gateway_server)
+            settle(simulator, frames + 1)
+            results.append(report('simulator: %d frames, %s' % (frames, name),
+                                  frames / (time.time() - started), 'frames/s'))
+            gateway_server._disconnect()
+    return results
+
+
+def bench_recovery(frames=SIMULATED_FRAMES, positions=RECOVERY_POSITIONS):
+    """
+    Compares sending frames notifications with send_notifications and a
+    resend window with and without an invalid token error at each of
+    positions, given as fractions of frames
+    """
+    results = []
+    for position in (None,) + tuple(positions):
+        invalid_token_at = [int(frames * position)] if position is not None else []
+        with GatewaySimulator(invalid_token_at=invalid_token_at) as simulator:
+            gateway_server = simulator.attach(APNs(enhanced=True, resend_window=frames)
+                                              .gateway_server)
+            probes = count(frames)
+
+            def probe():
+                gateway_server.send_notification(TOKEN_HEX, FROZEN_PAYLOAD, next(probes), EXPIRY)
+
+            started = time.time()
+            gateway_server.send_notifications(notifications(frames))
+            settle(simulator, frames - len(invalid_token_at), probe)
+            elapsed = time.time() - started
+            gateway_server._disconnect()
+        if position is None:
+            name = 'recovery: %d frames, no error' % frames
+        else:
+            name = 'recovery: %d frames, error at %d%%' % (frames, position * 100)
+        results.append(report(name, elapsed, 's'))
+    return results
+
+
+def bench_simulated_feedback(records=FEEDBACK_RECORDS):
+    results = []
+    with FeedbackSimulator() as simulator:
+        simulator.generate_backlog(records)
+        for name, consume in [('items', lambda f: sum(1 for item in f.items())),
+                              ('items(raw=True)', lambda f: sum(1 for item in f.items(raw=True))),
+                              ('fetch_all', lambda f: len(f.fetch_all()))]:
+            feedback_server = simulator.attach(APNs().feedback_server)
+            started = time.time()
+            assert consume(feedback_server) == records
+            results.append(report('simulator: %d feedback records, %s' % (records, name),
+                                  records / (time.time() - started), 'records/s'))
+            feedback_server._disconnect()
+    return results
+
+
+class MemoryPushNotificationStore(AbstractPushNotificationStore):
+    def __init__(self, notifications):
+        self.notifications = notifications
+        self.deleted = 0
+
+    def get_push_notifications(self):
+        return self.notifications
+
+    def delete_push_notifications(self, notifications):
+        self.deleted += len(notifications)
+
+
+class NullDeviceStore(AbstractDeviceStore):
+    def delete_devices_with_tokens(self, tokens):
+        pass
+
+
+def bench_managed_delivery(sizes=SIZES):
+    """Runs managed_delivery.send for sizes notifications against the simulators"""
+    results = []
+    with GatewaySimulator() as gateway, FeedbackSimulator() as feedback:
+        for size in sizes:
+            del gateway.notifications[:]
+            expiry = datetime.utcnow() + timedelta(days=1)
+            store = MemoryPushNotificationStore(
+                [PushNotification(TOKEN_HEX, FROZEN_PAYLOAD, expiry, False, 'com.app.1')
+                 for i in xrange(size)])
+            relay = PushNotificationRelay('cert', 'key', False)
+            relay._apns = APNs(enhanced=True)
+            gateway.attach(relay._apns.gateway_server)
+            feedback.attach(relay._apns.feedback_server)
+
+            started = time.time()
+            pn_provider = SpecificPushNotificationsProvider(PushNotificationsProvider(store),
+                                                            'com.app.1', False)
+            send(pn_provider, NullDeviceStore(), relay)
+            settle(gateway, size)
+            results.append(report('managed_delivery.send: %d notifications' % size,
+                                  size / (time.time() - started), 'frames/s'))
+            assert store.deleted == size
+            relay._apns.gateway_server._disconnect()
+            del store.notifications[:]
+    return results
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--json", dest="json_file",
+                      help="Write the results as JSON to this file, '-' for stdout")
+    parser.add_option("--sizes", dest="sizes", default=','.join(map(str, SIZES)),
+                      help="Comma separated numbers of notifications for managed_delivery.send")
+    parser.add_option("--frames", dest="frames", type="int", default=SIMULATED_FRAMES,
+                      help="Number of frames sent to the simulator")
+    options, args = parser.parse_args()
+
+    results = []
+    results += run(bench_frame_encoding())
+    results += run(bench_payload())
+    results += run(bench_bulk_sending(), number=NUMBER / 1000)
+    results += run(bench_feedback_parsing(), number=1)
+    results += bench_simulated_sending(options.frames)
+    results += bench_recovery(options.frames)
+    results += bench_simulated_feedback()
+    results += bench_managed_delivery([int(size) for size in options.sizes.split(',')])
+
+    if options.json_file:
+        document = json.dumps({'python': platform.python_version(),
+                               'platform': platform.platform(),
+                               'time': int(time.time()),
+                               'results': results}, indent=2, sort_keys=True)
+        if options.json_file == '-':
+            print document
+        else:
+            with open(options.json_file, 'w') as f:
+                f.write(document)
+
+
+if __name__ == '__main__':
+    main()
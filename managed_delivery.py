@@ -1,13 +1,35 @@
 import abc
+import heapq
+import sys
+import time
+from collections import OrderedDict
+from itertools import count
+from Queue import Queue, Empty, Full
+from multiprocessing.pool import ThreadPool
+from threading import Thread, Event, Lock
 from apns import APNs
 from apns import Payload
+from apns import expiry_timestamp
+from apns import MAX_IDENTIFIER
 from apnserrors import InvalidTokenError, ShutdownError
 
 __author__ = 'Denys Zadorozhnyi'
 
+DELETE_BATCH_SIZE = 1000
+PAGE_SIZE = 10000
+PREFETCH_PAGES = 2
+PREFETCH_POLL_INTERVAL = 0.5
+DISPATCH_CONCURRENCY = 4
+PRIORITY_URGENT = 10
+PRIORITY_BULK = 5
+COLLAPSE_KEY = 'collapse_key'
+COALESCE_WINDOW = 5.0
+DRAIN_TIMEOUT = 1.0
+
 
 class PushNotification(object):
-    def __init__(self, token, payload, expiry, use_sandbox, app_bundle_id):
+    def __init__(self, token, payload, expiry, use_sandbox, app_bundle_id,
+                 priority=PRIORITY_URGENT):
         assert token
         assert payload
         assert isinstance(payload, Payload)
@@ -18,6 +40,7 @@ class PushNotification(object):
         self.expiry = expiry
         self.app_bundle_id = app_bundle_id
         self.use_sandbox = use_sandbox
+        self.priority = priority
 
     def __repr__(self):
         attrs = ("token", "payload", "expiry", "app_bundle_id", "use_sandbox")
@@ -25,6 +48,135 @@ class PushNotification(object):
         return "%s(%s)" % (self.__class__.__name__, args)
 
 
+class NotificationQueue(object):
+    """
+    Notifications ordered by priority, highest first, then by expiry,
+    earliest first, then in the order they were pushed, so urgent
+    notifications overtake a queued bulk campaign. Notifications whose
+    expiry has passed are dropped when they reach the head of the queue,
+    before they are encoded or sent: dropped counts them and
+    expired_callback, if given, is called with each. Can be shared by
+    several threads.
+    """
+    def __init__(self, notifications=(), expired_callback=None):
+        self.expired_callback = expired_callback
+        self.dropped = 0
+        self._counter = count()
+        self._lock = Lock()
+        self._heap = [self._entry(n) for n in notifications]
+        heapq.heapify(self._heap)
+
+    def _entry(self, n):
+        # expiry 0 means the APNs doesn't store the notification, not that it expired
+        deadline = expiry_timestamp(n.expiry) or float('inf')
+        return (-n.priority, deadline, next(self._counter), n)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, notification):
+        with self._lock:
+            heapq.heappush(self._heap, self._entry(notification))
+
+    def extend(self, notifications):
+        entries = [self._entry(n) for n in notifications]
+        with self._lock:
+            self._heap.extend(entries)
+            heapq.heapify(self._heap)
+
+    def pop_batch(self, max_items, now=None):
+        """
+        Returns up to max_items unexpired notifications from the head of the
+        queue, dropping the expired ones on the way
+        """
+        if now is None:
+            now = time.time()
+        batch = []
+        expired = []
+        with self._lock:
+            heap = self._heap
+            while heap and len(batch) < max_items:
+                entry = heapq.heappop(heap)
+                if entry[1] <= now:
+                    expired.append(entry[3])
+                else:
+                    batch.append(entry[3])
+            self.dropped += len(expired)
+        if self.expired_callback:
+            for n in expired:
+                self.expired_callback(n)
+        return batch
+
+    def pop(self, now=None):
+        """Returns the next unexpired notification, or None if there's none left"""
+        batch = self.pop_batch(1, now)
+        return batch[0] if batch else None
+
+
+def coalesce_key(notification, collapse_key=COLLAPSE_KEY):
+    """
+    The key notifications are coalesced by: the token and the value of
+    collapse_key in the payload's custom dict, if any
+    """
+    return notification.token, notification.payload.custom.get(collapse_key)
+
+
+class NotificationCoalescer(object):
+    """
+    Holds each notification for window seconds, during which a newer
+    notification with the same coalesce_key() replaces it, and releases it
+    once the window, started by the first notification for the key, has
+    passed. Replaced notifications are counted in coalesced and passed to
+    superseded_callback, if given, e.g. to delete them from the store.
+    """
+    def __init__(self, window=COALESCE_WINDOW, collapse_key=COLLAPSE_KEY,
+                 superseded_callback=None):
+        self.window = window
+        self.collapse_key = collapse_key
+        self.superseded_callback = superseded_callback
+        self.coalesced = 0
+        # key -> [deadline, notification], in the order the keys were added,
+        # which is also the order of their deadlines
+        self._pending = OrderedDict()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, notification, now=None):
+        key = coalesce_key(notification, self.collapse_key)
+        entry = self._pending.get(key)
+        if entry is None:
+            if now is None:
+                now = time.time()
+            self._pending[key] = [now + self.window, notification]
+            return
+        superseded, entry[1] = entry[1], notification
+        self.coalesced += 1
+        if self.superseded_callback:
+            self.superseded_callback(superseded)
+
+    def ready(self, now=None):
+        """Returns the notifications whose window has passed, oldest first"""
+        if now is None:
+            now = time.time()
+        pending = self._pending
+        notifications = []
+        while pending:
+            key = next(iter(pending))
+            deadline, n = pending[key]
+            if deadline > now:
+                break
+            del pending[key]
+            notifications.append(n)
+        return notifications
+
+    def drain(self):
+        """Returns all of the held notifications, oldest first"""
+        notifications = [n for deadline, n in self._pending.itervalues()]
+        self._pending.clear()
+        return notifications
+
+
 class AbstractDeviceStore(object):
     __metaclass__ = abc.ABCMeta
 
@@ -34,6 +186,17 @@ class AbstractDeviceStore(object):
         return
 
 
+class LockedDeviceStore(AbstractDeviceStore):
+    """Serializes the calls to a device store shared by several threads"""
+    def __init__(self, device_store):
+        self._device_store = device_store
+        self._lock = Lock()
+
+    def delete_devices_with_tokens(self, tokens):
+        with self._lock:
+            return self._device_store.delete_devices_with_tokens(tokens)
+
+
 class AbstractPushNotificationStore(object):
     __metaclass__ = abc.ABCMeta
 
@@ -47,71 +210,270 @@ class AbstractPushNotificationStore(object):
         """Method doc"""
         return
 
+    def get_push_notification_pages(self, page_size):
+        """
+        Yields the pending notifications in lists of up to page_size. The
+        default slices get_push_notifications(); override it to page the
+        query itself. send_paged() calls it from a background thread.
+        """
+        #noinspection PyNoneFunctionAssignment
+        notifications = self.get_push_notifications() or []
+        for i in xrange(0, len(notifications), page_size):
+            yield notifications[i:i + page_size]
+
 
 class PushNotificationsProvider(object):
-    def __init__(self, store):
+    """
+    Keeps the pending notifications of a store indexed by (app_bundle_id,
+    use_sandbox), by token and by identity, so that lookups and deletions
+    cost O(1) per notification
+    """
+    def __init__(self, store, notifications=None):
+        """
+        Loads the notifications from the store, unless they are passed in
+        notifications (e.g. one page of the store)
+        """
         assert isinstance(store, AbstractPushNotificationStore)
         self._store = store
-        #noinspection PyNoneFunctionAssignment
-        self._notifications = self._store.get_push_notifications()
-        if self._notifications is None:
-            self._notifications = []
+        # (app_bundle_id, use_sandbox) -> OrderedDict(id(n) -> n), in store order
+        self._by_bundle = {}
+        # token -> n, or {id(n): n} for tokens with several notifications
+        self._by_token = {}
+        # id(n) -> (app_bundle_id, use_sandbox)
+        self._keys = {}
+        self._lock = Lock()
+        if notifications is None:
+            #noinspection PyNoneFunctionAssignment
+            notifications = self._store.get_push_notifications()
+        for n in notifications or ():
+            self._add(n)
+
+    def _add(self, n):
+        key = (n.app_bundle_id, n.use_sandbox)
+        bundle = self._by_bundle.get(key)
+        if bundle is None:
+            bundle = self._by_bundle[key] = OrderedDict()
+        bundle[id(n)] = n
+        same_token = self._by_token.get(n.token)
+        if same_token is None:
+            self._by_token[n.token] = n
+        elif isinstance(same_token, dict):
+            same_token[id(n)] = n
+        else:
+            self._by_token[n.token] = {id(same_token): same_token, id(n): n}
+        self._keys[id(n)] = key
+
+    def _remove(self, n):
+        key = self._keys.pop(id(n), None)
+        if key is None:
+            return False
+        bundle = self._by_bundle[key]
+        del bundle[id(n)]
+        if not bundle:
+            del self._by_bundle[key]
+        same_token = self._by_token[n.token]
+        if isinstance(same_token, dict):
+            del same_token[id(n)]
+            if not same_token:
+                del self._by_token[n.token]
+        else:
+            del self._by_token[n.token]
+        return True
+
+    def __len__(self):
+        return len(self._keys)
 
     def get_app_bundle_ids(self):
-        app_bundle_ids = set()
-        for n in self._notifications:
-            app_bundle_ids.add(n.app_bundle_id)
-        return list(app_bundle_ids)
+        with self._lock:
+            return list(set(app_bundle_id for app_bundle_id, use_sandbox in self._by_bundle))
+
+    def get_bundle_keys(self):
+        """Returns the (app_bundle_id, use_sandbox) pairs with pending notifications"""
+        with self._lock:
+            return self._by_bundle.keys()
 
     def get_notifications(self, app_bundle_id, use_sandbox):
-        return [n for n in self._notifications if
-                (n.app_bundle_id == app_bundle_id and n.use_sandbox == use_sandbox)]
+        with self._lock:
+            bundle = self._by_bundle.get((app_bundle_id, use_sandbox))
+            return bundle.values() if bundle else []
+
+    def get_notifications_for_tokens(self, tokens, app_bundle_id=None, use_sandbox=None):
+        """
+        Returns the notifications for the given tokens, optionally only the
+        ones for app_bundle_id and use_sandbox
+        """
+        key = (app_bundle_id, use_sandbox)
+        notifications = []
+        with self._lock:
+            for token in set(tokens):
+                same_token = self._by_token.get(token)
+                if same_token is None:
+                    continue
+                if not isinstance(same_token, dict):
+                    same_token = {id(same_token): same_token}
+                for n in same_token.itervalues():
+                    if app_bundle_id is None or self._keys[id(n)] == key:
+                        notifications.append(n)
+        return notifications
 
     def delete_notifications(self, notifications):
-        self._notifications = [n for n in self._notifications if
-                               n not in notifications]
-        self._store.delete_push_notifications(notifications)
+        with self._lock:
+            for n in notifications:
+                self._remove(n)
+            self._store.delete_push_notifications(notifications)
+
+
+def _send_order(notification):
+    return -notification.priority
 
 
 class SpecificPushNotificationsProvider(object):
-    def __init__(self, provider, app_bundle_id, for_sandbox):
+    """
+    The notifications of one (app_bundle_id, use_sandbox) pair, consumed
+    through a cursor: notifications before the cursor are acknowledged and
+    the ones after it that were removed by token are skipped. They are sent
+    by priority, highest first, and in store order within a priority, so
+    urgent notifications don't wait behind a bulk campaign. Deletions are
+    handed to the store in batches of delete_batch_size, and on flush().
+    Notifications that have already expired when loaded are deleted without
+    being sent and counted in dropped. With coalesce set, so are the ones
+    followed by a newer notification with the same coalesce_key(), which are
+    counted in coalesced. Only notifications whose payload carries
+    collapse_key are coalesced: stored notifications have no time to bound
+    a window by, and two alerts for a device may be hours apart.
+    """
+    def __init__(self, provider, app_bundle_id, for_sandbox,
+                 delete_batch_size=DELETE_BATCH_SIZE, coalesce=False,
+                 collapse_key=COLLAPSE_KEY):
         self._provider = provider
         self._app_bundle_id = app_bundle_id
         self._for_sandbox = for_sandbox
+        self._delete_batch_size = delete_batch_size
+        self._coalesce = coalesce
+        self._collapse_key = collapse_key
         self._notifications = []
+        self._positions = {}
+        self._cursor = 0
+        self._removed = set()
+        self._deleted = []
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
         self._load_notifications()
 
     def _load_notifications(self):
-        self._notifications = self._provider.get_notifications(self._app_bundle_id,
-                                                               self._for_sandbox)
+        loaded = self._provider.get_notifications(self._app_bundle_id, self._for_sandbox)
+        # sorted() is stable, so store order is kept within a priority
+        self._notifications = sorted(loaded, key=_send_order)
+        self._reset_positions()
+        now = time.time()
+        for n in loaded:
+            expiry = expiry_timestamp(n.expiry)
+            if expiry and expiry <= now:
+                self._removed.add(id(n))
+                self._delete(n)
+                self.dropped += 1
+        if self._coalesce:
+            collapsible = [n for n in loaded if id(n) not in self._removed
+                           and n.payload.custom.get(self._collapse_key) is not None]
+            newest = {}
+            for n in collapsible:
+                newest[coalesce_key(n, self._collapse_key)] = n
+            for n in collapsible:
+                if newest[coalesce_key(n, self._collapse_key)] is not n:
+                    self._removed.add(id(n))
+                    self._delete(n)
+                    self.coalesced += 1
+
+    def _reset_positions(self):
+        self._positions = dict((id(n), i) for i, n in enumerate(self._notifications))
+        self._cursor = 0
+        self._removed.clear()
+
+    def _compact(self):
+        if self._cursor or self._removed:
+            removed = self._removed
+            self._notifications = [n for n in self._notifications[self._cursor:]
+                                   if id(n) not in removed]
+            self._reset_positions()
+
+    def _delete(self, n):
+        self._deleted.append(n)
+        if len(self._deleted) >= self._delete_batch_size:
+            self.flush()
+
+    def __len__(self):
+        return len(self._notifications) - self._cursor - len(self._removed)
 
     def get_notifications(self):
+        self._compact()
         return self._notifications
 
+    def pending(self):
+        """A generator that yields (position, notification) from the cursor on"""
+        removed = self._removed
+        notifications = self._notifications
+        for position in xrange(self._cursor, len(notifications)):
+            n = notifications[position]
+            if id(n) not in removed:
+                yield position, n
+
+    def notification_at(self, position):
+        return self._notifications[position]
+
+    def next_position(self, position):
+        """
+        Returns the position of the first pending notification after
+        position, the one sent after it, or None if there is none
+        """
+        removed = self._removed
+        notifications = self._notifications
+        for next_position in xrange(max(position + 1, self._cursor), len(notifications)):
+            if id(notifications[next_position]) not in removed:
+                return next_position
+
+    def acknowledge(self, position):
+        """Deletes the notifications before position and moves the cursor to it"""
+        removed = self._removed
+        for n in self._notifications[self._cursor:position]:
+            if id(n) in removed:
+                removed.discard(id(n))
+            else:
+                self.sent += 1
+                self._delete(n)
+        self._cursor = max(self._cursor, min(position, len(self._notifications)))
+
+    def acknowledge_all(self):
+        self.acknowledge(len(self._notifications))
+
+    def flush(self):
+        """Hands the pending deletions to the store"""
+        if self._deleted:
+            deleted, self._deleted = self._deleted, []
+            self._provider.delete_notifications(deleted)
+
     def delete_notifications(self, notifications):
-        if len(notifications):
-            self._provider.delete_notifications(notifications)
-            self._load_notifications()
+        for n in notifications:
+            position = self._positions.get(id(n))
+            if position is None or position < self._cursor or id(n) in self._removed:
+                continue
+            self._removed.add(id(n))
+            self._delete(n)
 
     def delete_notifications_for_tokens(self, tokens):
         assert len(tokens)
-        notifications_to_delete = [n for n in self._notifications if n.token in tokens]
+        notifications_to_delete = self._provider.get_notifications_for_tokens(
+            tokens, self._app_bundle_id, self._for_sandbox)
         self.delete_notifications(notifications_to_delete)
 
     def delete_notifications_before_index(self, index):
         assert index
-        notifications_before_index = []
-        for i in range(0, len(self._notifications)):
-            if i == index:
-                break
-            else:
-                notifications_before_index.append(self._notifications[i])
-        if len(notifications_before_index):
-            self.delete_notifications(notifications_before_index)
+        self._compact()
+        self.acknowledge(index)
 
 
 class PushNotificationRelay(object):
-    def __init__(self, ssl_cert, ssl_key, use_sandbox):
+    def __init__(self, ssl_cert, ssl_key, use_sandbox, drain_timeout=DRAIN_TIMEOUT):
         # how to prepare the certs:
         # openssl pkcs12 -clcerts -nokeys -out cert.pem -in cert.p12
         # openssl pkcs12 -nocerts - nodes -out key.pem -in key.p12
@@ -121,6 +483,9 @@ class PushNotificationRelay(object):
         self._ssl_key = ssl_key
         self._use_sandbox = use_sandbox
         self._apns = None
+        self.drain_timeout = drain_timeout
+        # the identifier send() numbers from, which runs across its calls
+        self.next_identifier = 0
 
     def connect(self):
         if self._apns:
@@ -147,34 +512,170 @@ class PushNotificationRelay(object):
                                                     identifier=index,
                                                     expiry=notification.expiry)
 
+    def drain(self):
+        """
+        Waits up to drain_timeout seconds for an error response to the
+        notifications sent, which is raised
+        """
+        assert self._apns
+        self._apns.gateway_server.wait_for_error_response(self.drain_timeout)
+
 
 def send(pn_provider, device_store, pn_relay):
     assert isinstance(device_store, AbstractDeviceStore)
     assert isinstance(pn_provider, SpecificPushNotificationsProvider)
     assert isinstance(pn_relay, PushNotificationRelay)
-    notifications = pn_provider.get_notifications()
-    while len(notifications):
-        pn_relay.connect()
-        invalid_tokens = pn_relay.get_invalid_tokens_from_feedback()
-        if invalid_tokens and len(invalid_tokens):
-            device_store.delete_devices_with_tokens(invalid_tokens)
-            pn_provider.delete_notifications_for_tokens(invalid_tokens)
-            notifications = pn_provider.get_notifications()
+    # identifiers go on from the relay's previous call, e.g. for the previous
+    # page, so that a late error response to that call isn't taken for one
+    # of these; identifiers are base + position
+    base = pn_relay.next_identifier
+    span = 0
+    try:
+        while len(pn_provider):
+            pn_relay.connect()
+            invalid_tokens = pn_relay.get_invalid_tokens_from_feedback()
+            if invalid_tokens and len(invalid_tokens):
+                device_store.delete_devices_with_tokens(invalid_tokens)
+                pn_provider.delete_notifications_for_tokens(invalid_tokens)
+            try:
+                for position, notification in pn_provider.pending():
+                    span = max(span, position + 1)
+                    pn_relay.send(notification, (base + position) & MAX_IDENTIFIER)
+                # wait for an error response to the last ones before they are
+                # acknowledged
+                pn_relay.drain()
+            except InvalidTokenError as e:
+                # the rejected notification's id is returned
+                n_id = (e.identifier - base) & MAX_IDENTIFIER
+                if n_id >= span:
+                    # rejected in an earlier call; what was sent since is
+                    # dropped, so send it again
+                    continue
+                pn_provider.acknowledge(n_id)
+                invalid_token = pn_provider.notification_at(n_id).token
+                #log.info('APNS InvalidToken error returned notification id %s -> token %s',
+                #         str(n_id), invalid_token)
+                device_store.delete_devices_with_tokens([invalid_token])
+                pn_provider.delete_notifications_for_tokens([invalid_token])
+            except ShutdownError as e:
+                last = _position(e.identifier, base)
+                if last >= span:
+                    break
+                # last success sent id is returned; removed notifications
+                # were skipped, so the next one sent isn't necessarily + 1
+                n_id = pn_provider.next_position(last)
+                if n_id is None:
+                    pn_provider.acknowledge_all()
+                else:
+                    pn_provider.acknowledge(n_id)
+                break
+            else:
+                pn_provider.acknowledge_all()
+    finally:
+        pn_relay.next_identifier = (base + span) & MAX_IDENTIFIER
+        pn_provider.flush()
+
+
+def _position(identifier, base):
+    """
+    Returns the position of the notification sent with identifier by a
+    send() numbering from base, -1 for the one sent just before base
+    """
+    return ((identifier - base + 1) & MAX_IDENTIFIER) - 1
+
+
+def prefetch_pages(pages, prefetch=PREFETCH_PAGES):
+    """
+    A generator that yields the items of the pages iterator, which is read
+    in a background thread at most prefetch pages ahead. Exceptions raised
+    by pages are re-raised here.
+    """
+    queue = Queue(maxsize=prefetch)
+    stopped = Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=PREFETCH_POLL_INTERVAL)
+                return True
+            except Full:
+                pass
+        return False
+
+    def read():
         try:
-            for i in range(0, len(notifications)):
-                pn_relay.send(notifications[i], i)
-        except InvalidTokenError as e:
-            n_id = e.identifier + 1  # last success sent id is returned
-            pn_provider.delete_notifications_before_index(n_id)
-            invalid_token = notifications[n_id].token
-            #log.info('APNS InvalidToken error returned notification id %s -> token %s',
-            #         str(n_id), invalid_token)
-            device_store.delete_devices_with_tokens([invalid_token])
-            pn_provider.delete_notifications_for_tokens([invalid_token])
-        except ShutdownError as e:
-            n_id = e.identifier + 1  # last success sent id is returned
-            pn_provider.delete_notifications_before_index(n_id)
-            break
+            for page in pages:
+                if not put((page, None)):
+                    return
+        except Exception:
+            put((None, sys.exc_info()))
         else:
-            pn_provider.delete_notifications_before_index(len(notifications))
-        notifications = pn_provider.get_notifications()
+            put((None, None))
+
+    reader = Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            page, exc_info = queue.get()
+            if page is None:
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                break
+            yield page
+    finally:
+        stopped.set()
+        try:
+            while True:
+                queue.get_nowait()
+        except Empty:
+            pass
+
+
+def send_paged(store, device_store, get_relay, page_size=PAGE_SIZE, prefetch=PREFETCH_PAGES):
+    """
+    Sends the notifications of store page by page, starting on the first page
+    while the next ones are read in the background, so that at most prefetch
+    + 2 pages are in memory. get_relay(app_bundle_id, use_sandbox) returns the
+    PushNotificationRelay to send with; it is called once per pair.
+    """
+    assert isinstance(store, AbstractPushNotificationStore)
+    relays = {}
+    for page in prefetch_pages(store.get_push_notification_pages(page_size), prefetch):
+        pn_provider = PushNotificationsProvider(store, page)
+        for key in pn_provider.get_bundle_keys():
+            relay = relays.get(key)
+            if relay is None:
+                relay = relays[key] = get_relay(*key)
+            send(SpecificPushNotificationsProvider(pn_provider, *key), device_store, relay)
+
+
+def dispatch(pn_provider, device_store, get_relay, concurrency=DISPATCH_CONCURRENCY):
+    """
+    Runs send() for every (app_bundle_id, use_sandbox) pair of pn_provider on
+    up to concurrency threads, so that a slow bundle doesn't hold up the
+    others. get_relay(app_bundle_id, use_sandbox) returns the
+    PushNotificationRelay to send with. Returns a dict mapping each pair to
+    (sent, error): the number of notifications sent and the exception send()
+    raised, or None.
+    """
+    assert isinstance(pn_provider, PushNotificationsProvider)
+    device_store = LockedDeviceStore(device_store)
+
+    def send_bundle(key):
+        spec_pn_provider = SpecificPushNotificationsProvider(pn_provider, *key)
+        try:
+            send(spec_pn_provider, device_store, get_relay(*key))
+        except Exception as e:
+            return key, (spec_pn_provider.sent, e)
+        return key, (spec_pn_provider.sent, None)
+
+    keys = pn_provider.get_bundle_keys()
+    if not keys:
+        return {}
+    pool = ThreadPool(min(concurrency, len(keys)))
+    try:
+        return dict(pool.map(send_bundle, keys))
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,332 @@
+# A local stand-in for the APNs binary gateway and feedback servers, for
+# load and regression testing without Apple's servers. It speaks TLS with
+# the self-signed certificate in simulator.pem.
+
+import os
+import random
+import ssl
+import time
+from binascii import a2b_hex, b2a_hex
+from socket import (socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SHUT_RDWR,
+                    error as socket_error)
+from struct import Struct
+from threading import Thread, Lock
+
+from apns import MAX_PAYLOAD_LENGTH, TOKEN_LENGTH
+
+CERT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'simulator.pem')
+RECV_SIZE = 65536
+CLOSE_TIMEOUT = 1.0
+
+# error response statuses
+STATUS_INVALID_PAYLOAD_SIZE = 7
+STATUS_INVALID_TOKEN = 8
+STATUS_SHUTDOWN = 10
+
+# frame item ids of the command 2 format
+ITEM_TOKEN = 1
+ITEM_PAYLOAD = 2
+ITEM_IDENTIFIER = 3
+ITEM_EXPIRY = 4
+ITEM_PRIORITY = 5
+
+
+class SimulatedNotification(object):
+    """A notification received by GatewaySimulator"""
+    def __init__(self, command, token_hex, payload, identifier=0, expiry=0, priority=10):
+        self.command = command
+        self.token_hex = token_hex
+        self.payload = payload
+        self.identifier = identifier
+        self.expiry = expiry
+        self.priority = priority
+
+    def __repr__(self):
+        attrs = ("command", "token_hex", "identifier", "expiry", "priority")
+        args = ", ".join(["%s=%r" % (n, getattr(self, n)) for n in attrs])
+        return "%s(%s)" % (self.__class__.__name__, args)
+
+
+class Simulator(object):
+    """
+    A TLS server on host and port (port 0 picks a free one) that serves each
+    connection on a thread of its own. latency delays every read by that
+    many seconds and throughput, if set, caps the bytes read per second of
+    every connection. With idle_timeout set a connection that receives
+    nothing for that many seconds is dropped, as the APNs does. Use as a
+    context manager, or call start() and stop().
+    """
+    def __init__(self, host='127.0.0.1', port=0, cert_file=CERT_FILE, latency=0,
+                 throughput=None, idle_timeout=None):
+        super(Simulator, self).__init__()
+        self.cert_file = cert_file
+        self.latency = latency
+        self.throughput = throughput
+        self.idle_timeout = idle_timeout
+        self.connections = 0
+        self._lock = Lock()
+        self._listener = socket(AF_INET, SOCK_STREAM)
+        self._listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self._listener.bind((host, port))
+        self.address = self._listener.getsockname()
+        self._running = False
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self._listener.listen(16)
+        self._running = True
+        thread = Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        try:
+            # wake up accept()
+            socket(AF_INET, SOCK_STREAM).connect(self.address)
+        except socket_error:
+            pass
+        self._listener.close()
+
+    def attach(self, connection):
+        """Points an APNsConnection at this server"""
+        connection.server, connection.port = self.address
+        return connection
+
+    def _accept(self):
+        while self._running:
+            try:
+                sock, _ = self._listener.accept()
+            except socket_error:
+                break
+            if not self._running:
+                sock.close()
+                break
+            thread = Thread(target=self._serve, args=(sock,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, sock):
+        try:
+            conn = ssl.wrap_socket(sock, server_side=True, certfile=self.cert_file)
+        except (ssl.SSLError, socket_error):
+            sock.close()
+            return
+        with self._lock:
+            self.connections += 1
+        try:
+            conn.settimeout(self.idle_timeout)
+            self.handle(conn)
+            # send close_notify, as the client may be waiting for the end of the data
+            conn.settimeout(CLOSE_TIMEOUT)
+            conn.unwrap()
+            sock.shutdown(SHUT_RDWR)
+        except (ssl.SSLError, socket_error):
+            pass
+        finally:
+            conn.close()
+            sock.close()
+
+    def recv(self, conn):
+        """Reads from conn, applying latency and throughput"""
+        if self.latency:
+            time.sleep(self.latency)
+        data = conn.recv(RECV_SIZE)
+        if self.throughput and data:
+            time.sleep(float(len(data)) / self.throughput)
+        return data
+
+    def handle(self, conn):
+        """Serves one connection"""
+        raise NotImplementedError
+
+
+class GatewaySimulator(Simulator):
+    """
+    Accepts notifications in the simple (command 0), enhanced (command 1)
+    and frame (command 2) formats and keeps them in notifications.
+
+    Like the APNs it answers a bad notification with an error response and
+    closes the connection, dropping what was sent after it: tokens in
+    invalid_tokens and notifications whose identifier is in invalid_token_at
+    get an invalid token error, payloads over max_payload_length an invalid
+    payload size error. When a notification's identifier is in shutdown_at a
+    shutdown error with the identifier of the last notification received on
+    the connection is sent instead. Injected errors are only sent once.
+    """
+    simple_header = Struct('>BH')
+    enhanced_header = Struct('>BIIH')
+    frame_header = Struct('>BI')
+    item_header = Struct('>BH')
+    length_field = Struct('>H')
+    uint_field = Struct('>I')
+    error_response = Struct('>BBI')
+
+    def __init__(self, invalid_tokens=(), invalid_token_at=(), shutdown_at=(),
+                 max_payload_length=MAX_PAYLOAD_LENGTH, **kwargs):
+        super(GatewaySimulator, self).__init__(**kwargs)
+        self.invalid_tokens = set(invalid_tokens)
+        self.invalid_token_at = set(invalid_token_at)
+        self.shutdown_at = set(shutdown_at)
+        self.max_payload_length = max_payload_length
+        self.notifications = []
+        self.errors = []
+
+    def _parse(self, buff, offset):
+        """
+        Returns (notification, end) for the frame at offset, or (None, offset)
+        if it isn't complete yet
+        """
+        length = len(buff)
+        command = ord(buff[offset])
+        if command == 0:
+            header = self.simple_header
+            if length - offset < header.size:
+                return None, offset
+            _, token_length = header.unpack_from(buff, offset)
+            identifier = expiry = 0
+        elif command == 1:
+            header = self.enhanced_header
+            if length - offset < header.size:
+                return None, offset
+            _, identifier, expiry, token_length = header.unpack_from(buff, offset)
+        elif command == 2:
+            return self._parse_frame(buff, offset)
+        else:
+            raise ValueError('Unknown command %d' % command)
+
+        token_start = offset + header.size
+        payload_length_start = token_start + token_length
+        if length < payload_length_start + self.length_field.size:
+            return None, offset
+        payload_length, = self.length_field.unpack_from(buff, payload_length_start)
+        payload_start = payload_length_start + self.length_field.size
+        end = payload_start + payload_length
+        if length < end:
+            return None, offset
+        return SimulatedNotification(command, b2a_hex(buff[token_start:payload_length_start]),
+                                     buff[payload_start:end], identifier, expiry), end
+
+    def _parse_frame(self, buff, offset):
+        header = self.frame_header
+        if len(buff) - offset < header.size:
+            return None, offset
+        _, frame_length = header.unpack_from(buff, offset)
+        start = offset + header.size
+        end = start + frame_length
+        if len(buff) < end:
+            return None, offset
+        n = SimulatedNotification(2, '', '')
+        while start < end:
+            item_id, item_length = self.item_header.unpack_from(buff, start)
+            start += self.item_header.size
+            data = buff[start:start + item_length]
+            start += item_length
+            if item_id == ITEM_TOKEN:
+                n.token_hex = b2a_hex(data)
+            elif item_id == ITEM_PAYLOAD:
+                n.payload = data
+            elif item_id == ITEM_IDENTIFIER:
+                n.identifier, = self.uint_field.unpack(data)
+            elif item_id == ITEM_EXPIRY:
+                n.expiry, = self.uint_field.unpack(data)
+            elif item_id == ITEM_PRIORITY:
+                n.priority = ord(data)
+        return n, end
+
+    def _check(self, n, last_identifier):
+        """Returns (status, identifier) of the error response n gets, or None"""
+        with self._lock:
+            if n.identifier in self.shutdown_at:
+                self.shutdown_at.discard(n.identifier)
+                return STATUS_SHUTDOWN, last_identifier
+            if n.identifier in self.invalid_token_at:
+                self.invalid_token_at.discard(n.identifier)
+                return STATUS_INVALID_TOKEN, n.identifier
+        if n.token_hex in self.invalid_tokens or len(n.token_hex) != 2 * TOKEN_LENGTH:
+            return STATUS_INVALID_TOKEN, n.identifier
+        if len(n.payload) > self.max_payload_length:
+            return STATUS_INVALID_PAYLOAD_SIZE, n.identifier
+
+    def handle(self, conn):
+        buff = ''
+        last_identifier = 0
+        while True:
+            data = self.recv(conn)
+            if not data:
+                return
+            buff += data
+            offset = 0
+            received = []
+            error = None
+            while offset < len(buff):
+                n, end = self._parse(buff, offset)
+                if n is None:
+                    break
+                offset = end
+                error = self._check(n, last_identifier)
+                if error:
+                    break
+                received.append(n)
+                last_identifier = n.identifier
+            buff = buff[offset:]
+            with self._lock:
+                self.notifications.extend(received)
+                if error:
+                    self.errors.append(error)
+            if error:
+                conn.sendall(self.error_response.pack(8, *error))
+                self._discard(conn)
+                return
+
+    def _discard(self, conn):
+        """
+        Reads and drops what the client sends until it closes the connection,
+        or for at most CLOSE_TIMEOUT seconds. Closing a socket with unread data
+        resets the connection, and the client could lose the error response.
+        """
+        conn.settimeout(CLOSE_TIMEOUT)
+        try:
+            while conn.recv(RECV_SIZE):
+                pass
+        except (ssl.SSLError, socket_error):
+            pass
+
+
+class FeedbackSimulator(Simulator):
+    """
+    Sends every connection the (token_hex, fail_time_unix) records in
+    backlog and closes it. generate_backlog() fills it with random tokens.
+    The backlog is kept, so every connection gets the same records.
+    """
+    record_header = Struct('>IH')
+
+    def __init__(self, backlog=(), **kwargs):
+        super(FeedbackSimulator, self).__init__(**kwargs)
+        self.backlog = list(backlog)
+
+    def generate_backlog(self, n, fail_time=None):
+        """Appends n records with random tokens and returns their tokens"""
+        if fail_time is None:
+            fail_time = int(time.time())
+        tokens = ['%064x' % random.getrandbits(8 * TOKEN_LENGTH) for i in xrange(n)]
+        self.backlog.extend((token_hex, fail_time) for token_hex in tokens)
+        return tokens
+
+    def handle(self, conn):
+        header = self.record_header
+        data = ''.join(header.pack(fail_time, TOKEN_LENGTH) + a2b_hex(token_hex)
+                       for token_hex, fail_time in self.backlog)
+        for offset in xrange(0, len(data), RECV_SIZE):
+            if self.latency:
+                time.sleep(self.latency)
+            chunk = data[offset:offset + RECV_SIZE]
+            conn.sendall(chunk)
+            if self.throughput:
+                time.sleep(float(len(chunk)) / self.throughput)
@@ -2,15 +2,36 @@
 # coding: utf-8
 from binascii import a2b_hex
 from random import random
+from socket import socketpair, timeout, AF_UNIX, SOCK_DGRAM
+import logging
+from threading import Thread
 from datetime import datetime, timedelta
+import base64
 import hashlib
+import json
+import os
+import tempfile
 import time
 import unittest
 
 from apns import *
-from managed_delivery import PushNotification, AbstractDeviceStore, AbstractPushNotificationStore, send, PushNotificationsProvider, SpecificPushNotificationsProvider, PushNotificationRelay
+import simulator
+from simulator import GatewaySimulator, FeedbackSimulator
+from managed_delivery import PushNotification, AbstractDeviceStore, AbstractPushNotificationStore, send, PushNotificationsProvider, SpecificPushNotificationsProvider, PushNotificationRelay, prefetch_pages, send_paged, dispatch, NotificationQueue, PRIORITY_BULK, NotificationCoalescer
 import mock
 
+try:
+    import ecdsa
+except ImportError:
+    ecdsa = None
+
+try:
+    import h2.connection
+    import h2.events
+    import h2.settings
+except ImportError:
+    h2 = None
+
 APP_BUNDLE_ID1 = 'com.app.1'
 APP_BUNDLE_ID2 = 'com.app.2'
 
@@ -40,6 +61,56 @@ def mock_chunks_generator():
         data = data[BUF_SIZE:]
 
 
+class MockHTTP2Server(Thread):
+    """
+    A plain text HTTP/2 server that stands in for the APNs provider API. It
+    answers BadDeviceToken for bad_tokens and 200 for any other, and
+    allows two concurrent streams.
+    """
+    def __init__(self, bad_tokens=()):
+        Thread.__init__(self)
+        self.daemon = True
+        self.bad_tokens = bad_tokens
+        self.requests = []
+        self.max_open_streams = 0
+        self._listener = socket(AF_INET, SOCK_STREAM)
+        self._listener.bind(('127.0.0.1', 0))
+        self._listener.listen(1)
+        self.address = self._listener.getsockname()
+
+    def run(self):
+        sock, _ = self._listener.accept()
+        conn = h2.connection.H2Connection(client_side=False)
+        conn.initiate_connection()
+        conn.update_settings({h2.settings.MAX_CONCURRENT_STREAMS: 2})
+        sock.sendall(conn.data_to_send())
+        streams = {}
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            ended = []
+            for event in conn.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    streams[event.stream_id] = [dict(event.headers), '']
+                elif isinstance(event, h2.events.DataReceived):
+                    streams[event.stream_id][1] += event.data
+                elif isinstance(event, h2.events.StreamEnded):
+                    ended.append(event.stream_id)
+            self.max_open_streams = max(self.max_open_streams, len(streams))
+            for stream_id in ended:
+                headers, body = streams.pop(stream_id)
+                self.requests.append((headers, body))
+                if headers[':path'].split('/')[-1] in self.bad_tokens:
+                    conn.send_headers(stream_id, [(':status', '400')])
+                    conn.send_data(stream_id, '{"reason":"BadDeviceToken"}', end_stream=True)
+                else:
+                    conn.send_headers(stream_id, [(':status', '200')], end_stream=True)
+            sock.sendall(conn.data_to_send())
+        sock.close()
+        self._listener.close()
+
+
 class TestAPNs(unittest.TestCase):
     """Unit tests for PyAPNs"""
 
@@ -127,6 +198,681 @@ class TestAPNs(unittest.TestCase):
         self.assertEqual(len(notification), expected_length)
         self.assertEqual(notification[0], '\1')
 
+    def testFrameEncoder(self):
+        token_bin = a2b_hex(mock_tokens[0])
+        payload_json = Payload(alert=u'Héllo', badge=4).json()
+        expiry = datetime(2030, 1, 1)
+
+        encoder = FrameEncoder()
+        encoder.append_simple(token_bin, payload_json)
+        encoder.append_enhanced(token_bin, payload_json, 1234, expiry_timestamp(expiry))
+
+        expected = ('\0' + APNs.packed_ushort_big_endian(len(token_bin)) + token_bin
+                    + APNs.packed_ushort_big_endian(len(payload_json)) + payload_json
+                    + '\1' + APNs.packed_uint_big_endian(1234)
+                    + APNs.packed_uint_big_endian(int(time.mktime(expiry.timetuple())))
+                    + APNs.packed_ushort_big_endian(len(token_bin)) + token_bin
+                    + APNs.packed_ushort_big_endian(len(payload_json)) + payload_json)
+        self.assertEqual(encoder.getvalue(), expected)
+        self.assertEqual(len(encoder), len(expected))
+        self.assertEqual(FrameEncoder.pack_simple(token_bin, payload_json)
+                         + FrameEncoder.pack_enhanced(token_bin, payload_json, 1234,
+                                                      expiry_timestamp(expiry)),
+                         expected)
+
+        encoder.clear()
+        self.assertEqual(encoder.getvalue(), '')
+
+    def testSendNotifications(self):
+        apns = APNs(use_sandbox=True, enhanced=True)
+        gateway_server = apns.gateway_server
+        gateway_server.write = mock.Mock()
+
+        payload = Payload(alert="Hello World!")
+        expiry = datetime.utcnow() + timedelta(30)
+        notifications = [(t, payload, i, expiry) for i, t in enumerate(mock_tokens)]
+        frames = [gateway_server._get_enhanced_notification(*n) for n in notifications]
+
+        gateway_server.send_notifications(notifications)
+        self.assertEqual(gateway_server.write.call_args_list, [mock.call(''.join(frames))])
+
+        # A flush size smaller than two frames means one write per frame
+        gateway_server.write.reset_mock()
+        gateway_server.send_notifications(notifications, flush_size=len(frames[0]))
+        self.assertEqual(gateway_server.write.call_args_list,
+                         [mock.call(f) for f in frames])
+
+    def testSendNotificationsErrorResponse(self):
+        apns = APNs(use_sandbox=True, enhanced=True)
+        gateway_server = apns.gateway_server
+        gateway_server.write = mock.Mock(side_effect=[None, InvalidTokenError(1)])
+
+        payload = Payload(alert="Hello World!")
+        notifications = [(t, payload, i) for i, t in enumerate(mock_tokens[:3])]
+        frame_length = len(gateway_server._get_enhanced_notification(
+            mock_tokens[0], payload, 0, 0))
+
+        self.assertRaises(InvalidTokenError, gateway_server.send_notifications,
+                          notifications, flush_size=frame_length)
+        self.assertEqual(gateway_server.write.call_count, 2)
+
+    def testBroadcast(self):
+        payload = Payload(alert="Hello World!", frozen=True)
+        expiry = datetime.utcnow() + timedelta(30)
+        for enhanced in (True, False):
+            apns = APNs(use_sandbox=True, enhanced=enhanced)
+            gateway_server = apns.gateway_server
+            gateway_server.write = mock.Mock()
+
+            next_identifier = gateway_server.broadcast(mock_tokens, payload, expiry, 100)
+            self.assertEqual(next_identifier, 100 + NUM_MOCK_TOKENS)
+            if enhanced:
+                frames = [gateway_server._get_enhanced_notification(t, payload, 100 + i, expiry)
+                          for i, t in enumerate(mock_tokens)]
+            else:
+                frames = [gateway_server._get_notification(t, payload) for t in mock_tokens]
+            self.assertEqual(gateway_server.write.call_args_list, [mock.call(''.join(frames))])
+
+        self.assertEqual(gateway_server.broadcast([], payload, start_identifier=7), 7)
+
+    def testTokenSet(self):
+        tokens = TokenSet(mock_tokens[:5])
+        self.assertEqual(len(tokens), 5)
+        self.assertEqual(tokens.update_hex(mock_tokens[5:]), [])
+        self.assertEqual(len(tokens), NUM_MOCK_TOKENS)
+        self.assertEqual(list(tokens), mock_tokens)
+        for t in mock_tokens:
+            self.assertTrue(t in tokens)
+            self.assertTrue(a2b_hex(t) in tokens)
+        self.assertFalse('00' * 32 in tokens)
+        self.assertFalse('foo' in tokens)
+
+        # adding a token again changes nothing
+        tokens.add(mock_tokens[0])
+        self.assertEqual(len(tokens), NUM_MOCK_TOKENS)
+
+        tokens.discard(mock_tokens[3])
+        tokens.discard(mock_tokens[3])
+        self.assertFalse(mock_tokens[3] in tokens)
+        self.assertEqual(len(tokens), NUM_MOCK_TOKENS - 1)
+        self.assertEqual(list(tokens), mock_tokens[:3] + mock_tokens[4:])
+
+        # the removed slot is reused
+        new_token = 'ab' * 32
+        self.assertEqual(tokens.update_hex([new_token, 'zz' * 32, 'abc']), ['zz' * 32, 'abc'])
+        self.assertEqual(list(tokens), mock_tokens[:3] + [new_token] + mock_tokens[4:])
+        self.assertEqual(len(tokens._buffer), NUM_MOCK_TOKENS * 32)
+        # binary tokens must be given as such, not to update_hex
+        self.assertEqual(tokens.update_hex(['x' * 32]), ['x' * 32])
+
+        # binary views and bytearrays
+        copy = TokenSet(tokens.iter_binary())
+        self.assertEqual(list(copy), list(tokens))
+        self.assertEqual(len(copy._buffer), len(tokens) * 32)
+        for view in tokens.iter_binary():
+            self.assertTrue(view in copy)
+        # the set can't grow while a view of its buffer exists
+        del view
+        self.assertTrue(bytearray(a2b_hex(mock_tokens[0])) in copy)
+
+        # the hash table grows as needed
+        many = [hashlib.sha256(str(i)).hexdigest() for i in range(1000)]
+        tokens.update_hex(many)
+        self.assertEqual(len(tokens), NUM_MOCK_TOKENS + 1000)
+        self.assertTrue(all(t in tokens for t in many))
+
+    def testBroadcastTokenSet(self):
+        apns = APNs(use_sandbox=True, enhanced=True)
+        gateway_server = apns.gateway_server
+        gateway_server.write = mock.Mock()
+        payload = Payload(alert="Hello World!")
+
+        gateway_server.broadcast(TokenSet(mock_tokens), payload)
+        frames = [gateway_server._get_enhanced_notification(t, payload, i, 0)
+                  for i, t in enumerate(mock_tokens)]
+        self.assertEqual(gateway_server.write.call_args_list, [mock.call(''.join(frames))])
+
+    def testResendWindow(self):
+        error_callback = mock.Mock()
+        apns = APNs(use_sandbox=True, enhanced=True, resend_window=3,
+                    error_callback=error_callback)
+        gateway_server = apns.gateway_server
+
+        payload = Payload(alert="Hello World!")
+        frames = [gateway_server._get_enhanced_notification(t, payload, i, 0)
+                  for i, t in enumerate(mock_tokens[:6])]
+        written = []
+        errors = {4: InvalidTokenError(1)}
+
+        def mock_write(data):
+            if len(written) + 1 in errors:
+                written.append(None)
+                raise errors[len(written)]
+            written.append(data)
+        gateway_server.write = mock_write
+
+        for i, t in enumerate(mock_tokens[:5]):
+            gateway_server.send_notification(t, payload, i)
+        # frame 1 is rejected, so frame 2 is resent along with frame 3
+        self.assertEqual(written, [frames[0], frames[1], frames[2], None,
+                                   frames[2] + frames[3], frames[4]])
+        error_callback.assert_called_once_with(errors[4], mock_tokens[1])
+
+        # a shutdown after frame 3 resends frame 4 without reporting a notification
+        del written[:]
+        errors = {1: ShutdownError(3)}
+        gateway_server.send_notifications([(mock_tokens[5], payload, 5)])
+        self.assertEqual(written, [None, frames[4] + frames[5]])
+        self.assertEqual(error_callback.call_count, 1)
+
+        # an identifier that has left the window is raised
+        del written[:]
+        errors = {1: InvalidTokenError(0)}
+        self.assertRaises(InvalidTokenError, gateway_server.send_notification,
+                          mock_tokens[0], payload, 6)
+
+        # identifiers must be unique within the window
+        del written[:]
+        gateway_server.write = written.append
+        gateway_server.send_notification(mock_tokens[0], payload, 7)
+        self.assertRaises(ValueError, gateway_server.send_notification,
+                          mock_tokens[1], payload, 7)
+        self.assertRaises(ValueError, gateway_server.send_notifications,
+                          [(t, payload) for t in mock_tokens[1:3]])
+        self.assertEqual(len(written), 1)
+        for i in range(8, 11):
+            gateway_server.send_notification(mock_tokens[i - 8], payload, i)
+        gateway_server.send_notification(mock_tokens[3], payload, 7)
+        self.assertEqual(len(written), 5)
+
+    def testErrorResponseReader(self):
+        apns = APNs(use_sandbox=True, enhanced=True, error_reader=True)
+        gateway_server = apns.gateway_server
+        gateway_server._socket, server = socketpair()
+        gateway_server._ssl = gateway_server._socket
+        reader = ErrorResponseReader(gateway_server)
+        reader.start()
+
+        payload = Payload(alert="Hello World!")
+        gateway_server.send_notification(mock_tokens[0], payload, 1)
+        self.assertEqual(server.recv(4096),
+                         gateway_server._get_enhanced_notification(mock_tokens[0], payload,
+                                                                   1, 0))
+
+        server.sendall('\x08\x08\x00\x00\x00\x01')
+        reader.join(5)
+        self.assertFalse(reader.is_alive())
+        self.assertEqual(gateway_server._ssl, None)
+        try:
+            gateway_server.send_notification(mock_tokens[1], payload, 2)
+        except InvalidTokenError, err:
+            self.assertEqual(err.identifier, 1)
+        else:
+            self.fail('InvalidTokenError not raised')
+        server.close()
+
+        # error_callback is called by the reader, and only once
+        errors = []
+        with GatewaySimulator(invalid_token_at=[1]) as gateway:
+            apns = APNs(enhanced=True, error_reader=True, resend_window=10,
+                        error_callback=lambda err, token_hex: errors.append((err, token_hex)))
+            gateway_server = gateway.attach(apns.gateway_server)
+            gateway_server.send_notification(mock_tokens[0], payload, 0)
+            gateway_server.send_notification(mock_tokens[1], payload, 1)
+            for i in range(50):
+                if errors:
+                    break
+                time.sleep(0.05)
+            self.assertEqual([(type(err), err.identifier, token_hex) for err, token_hex in errors],
+                             [(InvalidTokenError, 1, mock_tokens[1])])
+            gateway_server.send_notification(mock_tokens[2], payload, 2)
+            self.assertEqual(len(errors), 1)
+
+    def testGatewayMultiplexer(self):
+        connections = [GatewayConnection(use_sandbox=True, enhanced=True) for i in range(2)]
+        servers = []
+        for connection in connections:
+            connection._socket, server = socketpair()
+            connection._ssl = connection._socket
+            connection._ssl.setblocking(0)
+            servers.append(server)
+        error_callback = mock.Mock()
+        multiplexer = GatewayMultiplexer(connections, high_water=250,
+                                         error_callback=error_callback)
+
+        payload = Payload(alert="Hello World!")
+        frames = [connections[0]._get_enhanced_notification(t, payload, i, 0)
+                  for i, t in enumerate(mock_tokens)]
+        for i, t in enumerate(mock_tokens[:2]):
+            self.assertTrue(multiplexer.send_notification(connections[0], t, payload, i))
+        self.assertFalse(multiplexer.send_notification(connections[0], mock_tokens[2],
+                                                       payload, 2))
+        multiplexer.send_notification(connections[1], mock_tokens[3], payload, 3)
+        self.assertEqual(multiplexer.pending(), sum(len(f) for f in frames[:4]))
+
+        multiplexer.drain()
+        self.assertEqual(multiplexer.pending(), 0)
+        self.assertEqual(servers[0].recv(4096), ''.join(frames[:3]))
+        self.assertEqual(servers[1].recv(4096), frames[3])
+
+        servers[1].sendall('\x08\x08\x00\x00\x00\x03')
+        self.assertEqual(multiplexer.poll(5), 1)
+        error_callback.assert_called_once_with(connections[1], mock.ANY)
+        err = error_callback.call_args[0][1]
+        self.assertTrue(isinstance(err, InvalidTokenError))
+        self.assertEqual(err.identifier, 3)
+        self.assertEqual(connections[1]._ssl, None)
+        for server in servers:
+            server.close()
+
+        # a frame written in part is written in full on the next connection
+        connection = connections[0]
+        connection._ssl = mock.Mock()
+        connection._ssl.send.return_value = len(frames[0]) + 10
+        multiplexer = GatewayMultiplexer([connection])
+        for i, t in enumerate(mock_tokens[:3]):
+            multiplexer.send_notification(connection, t, payload, i)
+        multiplexer._write(connection)
+        connection._ssl = None
+        with mock.patch.object(connection, '_read_error_response',
+                               return_value=InvalidTokenError(0)):
+            multiplexer._read(connection)
+        self.assertEqual(multiplexer.pending(), len(frames[1]) + len(frames[2]))
+        written = []
+        connection._ssl = mock.Mock()
+        connection._ssl.send.side_effect = lambda data: written.append(data.tobytes()) or len(data)
+        multiplexer._write(connection)
+        self.assertEqual(written, [frames[1] + frames[2]])
+
+        # a socket nobody reads from times out
+        connection._socket, server = socketpair()
+        connection._ssl = connection._socket
+        connection._ssl.setblocking(0)
+        multiplexer = GatewayMultiplexer([connection])
+        while multiplexer.pending() < 1 << 20:
+            multiplexer.send_notification(connection, mock_tokens[0], payload)
+        self.assertRaises(timeout, multiplexer.drain, 0.2)
+        self.assertTrue(multiplexer.pending() > 0)
+        server.close()
+        connection._disconnect()
+
+    def testGatewayConnectionPool(self):
+        apns = APNs(use_sandbox=True, enhanced=True, pool_size=3)
+        pool = apns.gateway_pool
+        self.assertEqual(len(pool), 3)
+        for connection in pool.connections:
+            self.assertEqual(connection.server, 'gateway.sandbox.push.apple.com')
+            self.assertTrue(connection.enhanced)
+            connection.send_notification = mock.Mock()
+
+        payload = Payload(alert="Hello World!")
+        for i in range(6):
+            pool.send_notification(mock_tokens[i], payload, i)
+        for connection in pool.connections:
+            self.assertEqual(connection.send_notification.call_count, 2)
+
+        # with token dispatch a token always goes to the same connection
+        pool.dispatch = 'token'
+        for connection in pool.connections:
+            connection.send_notification.reset_mock()
+        for i in range(3):
+            pool.send_notification(mock_tokens[0], payload, i)
+        self.assertEqual(sorted(c.send_notification.call_count for c in pool.connections),
+                         [0, 0, 3])
+
+        # a failed connection is replaced and the notification sent again
+        index = int(mock_tokens[0][:8], 16) % 3
+        failed = pool.connections[index]
+        failed.send_notification.side_effect = socket_error(32, 'Broken pipe')
+        with mock.patch.object(GatewayConnection, 'send_notification') as send_notification:
+            pool.send_notification(mock_tokens[0], payload, 3)
+            send_notification.assert_called_once_with(mock_tokens[0], payload, 3, 0)
+        self.assertNotEqual(pool.connections[index], failed)
+
+        # in enhanced mode the connections handle error responses themselves
+        errors = []
+        with GatewaySimulator(invalid_tokens=[mock_tokens[1]]) as gateway:
+            pool = APNs(enhanced=True, pool_size=2,
+                        error_callback=lambda err, token_hex: errors.append((err, token_hex))
+                        ).gateway_pool
+            for connection in pool.connections:
+                self.assertEqual(connection._sent.maxlen, POOL_RESEND_WINDOW)
+                gateway.attach(connection)
+            for t in mock_tokens[:6]:
+                pool.send_notification(t, payload)
+                time.sleep(0.05)
+            pool.send_notifications([(t, payload) for t in mock_tokens[6:8]])
+            pool.close()
+            time.sleep(0.1)
+            self.assertEqual(sorted(n.identifier for n in gateway.notifications),
+                             [0, 2, 3, 4, 5, 6, 7])
+            self.assertEqual([(type(err), token_hex) for err, token_hex in errors],
+                             [(InvalidTokenError, mock_tokens[1])])
+
+    def testMemoryMetrics(self):
+        metrics = MemoryMetrics()
+        for value in (1, 2, 3, 0.25):
+            metrics.observe('flush.bytes', value)
+        metrics.count('connects')
+        metrics.count('write.bytes', 100)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters'], {'connects': 1, 'write.bytes': 100})
+        self.assertEqual(snapshot['histograms']['flush.bytes'],
+                         {'count': 4, 'sum': 6.25, 'min': 0.25, 'max': 3,
+                          'buckets': {0.25: 1, 1.0: 1, 2.0: 1, 4.0: 1}})
+        metrics.reset()
+        self.assertEqual(metrics.snapshot(), {'counters': {}, 'histograms': {}})
+
+    def testConnectionMetrics(self):
+        metrics = MemoryMetrics()
+        apns = APNs(use_sandbox=True, enhanced=True, metrics=metrics)
+        gateway_server = apns.gateway_server
+        gateway_server.write = mock.Mock()
+        payload = Payload(alert="Hello World!")
+        gateway_server.send_notifications((t, payload, i) for i, t in enumerate(mock_tokens))
+        gateway_server.send_notification(mock_tokens[0], payload)
+
+        feedback_server = apns.feedback_server
+        feedback_server._chunks = mock_chunks_generator
+        self.assertEqual(len(list(feedback_server.items())), NUM_MOCK_TOKENS)
+
+        gateway_server.recvall = mock.Mock(return_value='\x08\x08\x00\x00\x00\x01')
+        self.assertTrue(isinstance(gateway_server._read_error_response(), InvalidTokenError))
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters'], {'write.frames': NUM_MOCK_TOKENS + 1,
+                                                'feedback.items': NUM_MOCK_TOKENS,
+                                                'error_responses.8': 1})
+        histograms = snapshot['histograms']
+        self.assertEqual(histograms['encode.json']['count'], NUM_MOCK_TOKENS + 1)
+        self.assertEqual(histograms['encode.batch']['count'], 1)
+        self.assertEqual(histograms['flush.bytes']['sum'], len(gateway_server.write.call_args_list[0][0][0]))
+
+        # the default sink measures nothing
+        self.assertFalse(APNs().gateway_server.metrics.enabled)
+
+    def testMetricsSinks(self):
+        logger = mock.Mock()
+        metrics = LoggingMetrics(logger)
+        metrics.timing('connect', 0.25)
+        logger.log.assert_called_with(logging.DEBUG, '%s %.3fms', 'connect', 250)
+
+        client, server = socketpair(AF_UNIX, SOCK_DGRAM)
+        metrics = StatsdMetrics(prefix='push')
+        metrics._socket = mock.Mock()
+        metrics._socket.sendto = lambda line, address: client.send(line)
+        metrics.count('write.bytes', 100)
+        metrics.timing('connect', 0.25)
+        metrics.observe('flush.bytes', 512)
+        self.assertEqual([server.recv(100) for i in range(3)],
+                         ['push.write.bytes:100|c', 'push.connect:250.000|ms',
+                          'push.flush.bytes:512|h'])
+
+    def testGatewaySimulator(self):
+        errors = []
+        with GatewaySimulator(invalid_tokens=[mock_tokens[2]], shutdown_at=[6]) as simulator:
+            apns = APNs(enhanced=True, resend_window=10,
+                        error_callback=lambda err, token_hex: errors.append((err, token_hex)))
+            gateway_server = simulator.attach(apns.gateway_server)
+            payload = Payload(alert="Hello World!")
+            for i, token_hex in enumerate(mock_tokens):
+                gateway_server.send_notification(token_hex, payload, i)
+                time.sleep(0.05)
+            gateway_server._disconnect()
+
+            self.assertEqual([n.identifier for n in simulator.notifications],
+                             [0, 1, 3, 4, 5, 6, 7, 8, 9])
+            self.assertEqual(simulator.notifications[0].token_hex, mock_tokens[0])
+            self.assertEqual(json.loads(simulator.notifications[0].payload), payload.dict())
+            self.assertEqual([(type(err), token_hex) for err, token_hex in errors],
+                             [(InvalidTokenError, mock_tokens[2])])
+            self.assertEqual(simulator.errors, [(8, 2), (10, 5)])
+            self.assertEqual(simulator.connections, 3)
+
+            # the simple format
+            gateway_server = simulator.attach(APNs().gateway_server)
+            gateway_server.send_notification(mock_tokens[0], payload)
+            gateway_server._disconnect()
+            time.sleep(0.1)
+            self.assertEqual(simulator.notifications[-1].command, 0)
+            self.assertEqual(simulator.notifications[-1].token_hex, mock_tokens[0])
+
+    def testWaitForErrorResponse(self):
+        payload = Payload(alert="Hello")
+        with GatewaySimulator(invalid_token_at=[1]) as gateway:
+            connection = gateway.attach(GatewayConnection(enhanced=True))
+            connection.send_notification(mock_tokens[0], payload, 0)
+            started = time.time()
+            connection.wait_for_error_response(0.2)
+            self.assertTrue(time.time() - started >= 0.2)
+
+            connection.send_notification(mock_tokens[1], payload, 1)
+            try:
+                connection.wait_for_error_response(5)
+            except InvalidTokenError, err:
+                self.assertEqual(err.identifier, 1)
+            else:
+                self.fail('InvalidTokenError not raised')
+            self.assertEqual(connection._ssl, None)
+            connection.wait_for_error_response(5)
+
+        # closed without an error response, without a TLS close
+        with GatewaySimulator(idle_timeout=0.1) as gateway:
+            connection = gateway.attach(GatewayConnection(enhanced=True))
+            connection.send_notification(mock_tokens[0], payload, 0)
+            started = time.time()
+            connection.wait_for_error_response(5)
+            self.assertTrue(time.time() - started < 2)
+            self.assertEqual(connection._ssl, None)
+
+        # and cleanly
+        connection = GatewayConnection(enhanced=True)
+        connection._socket, server = socketpair()
+        connection._ssl = connection._socket
+        server.close()
+        started = time.clock()
+        connection.wait_for_error_response(0.5)
+        self.assertTrue(time.clock() - started < 0.1)
+        self.assertEqual(connection._ssl, None)
+
+    def testSSLContextCache(self):
+        clear_ssl_contexts()
+        cert_file = simulator.CERT_FILE
+        context = ssl_context(cert_file, None)
+        self.assertTrue(context is ssl_context(cert_file, None))
+        self.assertFalse(context is ssl_context(cert_file, None, use_sandbox=True))
+
+        with GatewaySimulator() as gateway:
+            connections = [gateway.attach(APNs(cert_file=cert_file, enhanced=enhanced).gateway_server)
+                           for enhanced in (True, False, True)]
+            with mock.patch('apns.SSLContext', wraps=SSLContext) as new_context:
+                for i, connection in enumerate(connections):
+                    connection.send_notification(mock_tokens[0], Payload(alert="Hello"), i)
+                    connection._disconnect()
+                    connection.send_notification(mock_tokens[0], Payload(alert="Hello"), i)
+                self.assertFalse(new_context.called)
+            time.sleep(0.1)
+            self.assertEqual(len(gateway.notifications), 6)
+        clear_ssl_contexts()
+        self.assertFalse(context is ssl_context(cert_file, None))
+
+    def testConnectionKeeper(self):
+        payload = Payload(alert="Hello")
+        with GatewaySimulator(idle_timeout=0.3, invalid_token_at=[1]) as gateway:
+            for enhanced in (True, False):
+                connection = gateway.attach(GatewayConnection(enhanced=enhanced))
+                connects = gateway.connections
+                connection.keep_alive(interval=0.05)
+                time.sleep(0.1)
+                # pre-warmed
+                self.assertTrue(connection._ssl is not None)
+                self.assertEqual(gateway.connections, connects + 1)
+                # dropped by the server while idle and reopened
+                time.sleep(0.4)
+                self.assertTrue(connection._ssl is not None)
+                self.assertEqual(gateway.connections, connects + 2)
+
+            # an error response read while idle is raised by the next write
+            connection = gateway.attach(GatewayConnection(enhanced=True))
+            connection.keep_alive(interval=0.05)
+            connection.send_notification(mock_tokens[0], payload, 1)
+            time.sleep(0.15)
+            self.assertRaises(InvalidTokenError, connection.send_notification,
+                              mock_tokens[0], payload, 2)
+
+        with GatewaySimulator() as gateway:
+            connection = gateway.attach(GatewayConnection(enhanced=True))
+            connection.keep_alive(interval=0.05, idle_ttl=0.2)
+            time.sleep(0.5)
+            self.assertTrue(gateway.connections >= 2)
+
+        with mock.patch.object(GatewayConnection, 'keep_alive') as keep_alive:
+            apns = APNs(keep_alive=True, idle_ttl=60, pool_size=2)
+            self.assertTrue(apns._gateway_connection is not None)
+            keep_alive.assert_called_with(idle_ttl=60)
+            apns.gateway_pool
+            self.assertEqual(keep_alive.call_count, 3)
+
+    def testFeedbackSimulator(self):
+        with FeedbackSimulator() as simulator:
+            tokens = simulator.generate_backlog(5000, fail_time=1400000000)
+            feedback_server = simulator.attach(APNs().feedback_server)
+            batch = feedback_server.fetch_all()
+            self.assertEqual(batch.tokens_hex(), tokens)
+            self.assertEqual(set(batch.fail_times), set([1400000000]))
+
+    def testTokenBucket(self):
+        bucket = TokenBucket(100, burst=10, min_rate=20, increase=0)
+        self.assertEqual(bucket.reserve(10), 0)
+        self.assertAlmostEqual(bucket.reserve(5), 0.05, places=2)
+        bucket.back_off()
+        self.assertEqual(bucket.rate, 50)
+        self.assertTrue(bucket.reserve() > 0.1)
+        bucket.back_off()
+        bucket.back_off()
+        self.assertEqual(bucket.rate, 20)
+
+        bucket = TokenBucket(100, increase=10000)
+        bucket.back_off()
+        time.sleep(0.02)
+        bucket.reserve(0)
+        self.assertEqual(bucket.rate, 100)
+
+    def testPacedGatewayConnection(self):
+        shared = TokenBucket(1000000)
+        apns = APNs(use_sandbox=True, enhanced=True, resend_window=10,
+                    pacing=[TokenBucket(200, burst=1), shared])
+        gateway_server = apns.gateway_server
+        self.assertEqual(gateway_server.rate, 200)
+        written = []
+        gateway_server.write = written.append
+        payload = Payload(alert="Hello World!")
+
+        started = time.time()
+        gateway_server.send_notifications((t, payload, i) for i, t in enumerate(mock_tokens))
+        gateway_server.send_notification(mock_tokens[0], payload, 10)
+        self.assertTrue(time.time() - started >= 0.045)
+
+        # a shutdown resent from the window backs the buckets off
+        responses = iter([ShutdownError(10), None])
+        def write(data):
+            err = next(responses)
+            if err:
+                raise err
+        gateway_server.write = write
+        gateway_server.send_notification(mock_tokens[1], payload, 11)
+        self.assertAlmostEqual(gateway_server.rate, 100, delta=1)
+        self.assertAlmostEqual(shared.rate, 500000, delta=1000)
+
+        gateway_server.write = mock.Mock(side_effect=socket_error(32, 'Broken pipe'))
+        self.assertRaises(socket_error, gateway_server.send_notification,
+                          mock_tokens[2], payload, 12)
+        self.assertAlmostEqual(gateway_server.rate, 50, delta=1)
+
+        # a shutdown that has left the window is raised, and backed off once
+        gateway_server.pacing = [TokenBucket(1000)]
+        gateway_server.write = mock.Mock(side_effect=ShutdownError(3))
+        self.assertRaises(ShutdownError, gateway_server.send_notification,
+                          mock_tokens[3], payload, 13)
+        self.assertAlmostEqual(gateway_server.rate, 500, delta=5)
+
+        pool =GatewayConnectionPool(2, connection_rate=10, pacing=shared)
+        self.assertEqual([c.rate for c in pool.connections], [10, 10])
+        self.assertEqual(pool.connections[0].pacing[1], shared)
+
+    @unittest.skipIf(h2 is None or not support_http2, 'requires h2 and hyper')
+    def testHTTP2Connection(self):
+        server = MockHTTP2Server(bad_tokens=[mock_tokens[2]])
+        server.start()
+        apns = APNs(use_sandbox=True, topic='com.app.1')
+        http2_server = apns.http2_server
+        self.assertEqual(http2_server.server, 'api.development.push.apple.com')
+        http2_server.server, http2_server.port = server.address
+        http2_server.secure = False
+
+        payload = Payload(alert="Hello World!")
+        self.assertEqual(http2_server.send_notification(mock_tokens[0], payload), (200, None))
+        results = list(http2_server.send_notifications(
+            [(t, payload, i, 1234) for i, t in enumerate(mock_tokens)]))
+        self.assertEqual(results, [(i, 400, 'BadDeviceToken') if i == 2 else (i, 200, None)
+                                   for i in range(NUM_MOCK_TOKENS)])
+
+        http2_server._disconnect()
+        server.join(5)
+        self.assertEqual(len(server.requests), NUM_MOCK_TOKENS + 1)
+        headers, body = server.requests[-1]
+        self.assertEqual(headers[':path'], '/3/device/' + mock_tokens[-1])
+        self.assertEqual(headers['apns-topic'], 'com.app.1')
+        self.assertEqual(headers['apns-expiration'], '1234')
+        self.assertEqual(body, payload.json())
+        self.assertTrue(server.max_open_streams <= 2)
+
+    @unittest.skipIf(ecdsa is None, 'requires ecdsa')
+    def testProviderToken(self):
+        key = ecdsa.SigningKey.generate(curve=ecdsa.NIST256p)
+        fd, key_file = tempfile.mkstemp(suffix='.p8')
+        os.write(fd, key.to_pem(format='pkcs8'))
+        os.close(fd)
+        try:
+            provider_token = ProviderToken(key_file, 'ABC123DEFG', 'DEF123GHIJ')
+        finally:
+            os.remove(key_file)
+
+        def b64decode(data):
+            return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+        token = provider_token.get()
+        self.assertTrue(provider_token.get() is token)
+        header, claims, signature = token.split('.')
+        self.assertEqual(json.loads(b64decode(header)), {'alg': 'ES256', 'kid': 'ABC123DEFG'})
+        self.assertEqual(json.loads(b64decode(claims))['iss'], 'DEF123GHIJ')
+        self.assertTrue(key.get_verifying_key().verify(
+            b64decode(signature), header + '.' + claims, hashfunc=hashlib.sha256))
+
+        # the token is signed again once it is due
+        with mock.patch('time.time', return_value=time.time() + 50 * 60):
+            new_token = provider_token.get()
+        self.assertNotEqual(new_token, token)
+        self.assertTrue(provider_token.get() is new_token)
+
+        # while another thread signs, the previous token is used
+        provider_token._current = (token, 0)
+        provider_token._lock.acquire()
+        self.assertTrue(provider_token.get() is token)
+        provider_token._lock.release()
+
+    @unittest.skipIf(not support_http2, 'requires hyper')
+    def testHTTP2ConnectionProviderToken(self):
+        provider_token = mock.Mock()
+        provider_token.get.return_value = 'eyJ.eyJ.sig'
+        apns = APNs(use_sandbox=True, topic='com.app.1', provider_token=provider_token)
+        http2_server = apns.http2_server
+        http2_server._http = mock.Mock()
+
+        http2_server._request(mock_tokens[0], Payload(alert="Hello World!"))
+        _, _, _, headers = http2_server._http.request.call_args[0]
+        self.assertEqual(headers['authorization'], 'bearer eyJ.eyJ.sig')
+
     def testFeedbackServer(self):
         pem_file = TEST_CERTIFICATE
         apns = APNs(use_sandbox=True, cert_file=pem_file, key_file=pem_file)
@@ -144,6 +890,39 @@ class TestAPNs(unittest.TestCase):
             i += 1
         self.assertEqual(i, NUM_MOCK_TOKENS)
 
+    def testFeedbackServerRaw(self):
+        apns = APNs(use_sandbox=True)
+        feedback_server = apns.feedback_server
+        feedback_server._socket, server = socketpair()
+        feedback_server._ssl = feedback_server._socket
+
+        data = ''.join(chunk for chunk in mock_chunks_generator())
+        server.sendall(data)
+        server.close()
+
+        items = list(feedback_server.items(raw=True))
+        self.assertEqual([token_bin for token_bin, fail_time in items],
+                         [a2b_hex(t) for t in mock_tokens])
+        self.assertEqual(items[0][1], APNs.unpacked_uint_big_endian(data[0:4]))
+
+    def testFeedbackServerBatches(self):
+        apns = APNs(use_sandbox=True)
+        feedback_server = apns.feedback_server
+        feedback_server._chunks = mock_chunks_generator
+
+        batches = list(feedback_server.items_batch(4))
+        self.assertEqual([len(b) for b in batches], [4, 4, 2])
+        self.assertEqual(sum((b.tokens_hex() for b in batches), []), mock_tokens)
+
+        batch = feedback_server.fetch_all()
+        self.assertEqual(len(batch), NUM_MOCK_TOKENS)
+        self.assertEqual(str(batch.tokens), ''.join(a2b_hex(t) for t in mock_tokens))
+        self.assertEqual(len(batch.fail_times), NUM_MOCK_TOKENS)
+        self.assertTrue(abs(batch.fail_times[0] - time.time()) < 60)
+        tokens = batch.token_set()
+        self.assertEqual(len(tokens), NUM_MOCK_TOKENS)
+        self.assertTrue(mock_tokens[3] in tokens)
+
     def testPayloadAlert(self):
         pa = PayloadAlert('foo')
         d = pa.dict()
@@ -207,6 +986,21 @@ class TestAPNs(unittest.TestCase):
         self.assertEqual(d, {'foo': 'bar', 'aps': {'alert': 'foobar', 'content-available': 1}})
 
 
+    def testFrozenPayload(self):
+        p = Payload(alert='foo', badge=1, frozen=True)
+        payload_json = p.json()
+        self.assertTrue(p.json() is payload_json)
+        self.assertEqual(payload_json, Payload(alert='foo', badge=1).json())
+
+        # assigning a field invalidates the cached JSON
+        p.badge = 2
+        self.assertEqual(p.json(), Payload(alert='foo', badge=2).json())
+        self.assertTrue(p.json() is p.json())
+
+        # payloads that aren't frozen are encoded every time
+        p = Payload(alert='foo')
+        self.assertFalse(p.json() is p.json())
+
     def testPayloadTooLargeError(self):
         # The maximum size of the JSON payload is MAX_PAYLOAD_LENGTH 
         # bytes. First determine how many bytes this allows us in the
@@ -391,7 +1185,7 @@ class TestManagedDelivery(unittest.TestCase):
             if identifier == 1:
                 self.assertEqual(payload, notifications[1].payload)
                 self.assertEqual(token_hex, notifications[1].token)
-                raise InvalidTokenError(0)
+                raise InvalidTokenError(1)
             else:
                 self.assertEqual(payload, notifications[0].payload)
                 self.assertEqual(token_hex, notifications[0].token)
@@ -403,6 +1197,72 @@ class TestManagedDelivery(unittest.TestCase):
         mock_device_store.delete_devices_with_tokens.assert_called_with([invalid_token])
 
 
+    def test_send_invalid_token_after_removed(self):
+        mock_pn_store = self.MockPushNotificationStore()
+        for i in range(2):
+            mock_pn_store._notifications.append(mock_pn_store.generate_pn(True, APP_BUNDLE_ID1))
+        notifications = [n for n in mock_pn_store.get_push_notifications()
+                         if n.app_bundle_id == APP_BUNDLE_ID1 and n.use_sandbox]
+        pn_provider = SpecificPushNotificationsProvider(PushNotificationsProvider(mock_pn_store),
+                                                        app_bundle_id=APP_BUNDLE_ID1,
+                                                        for_sandbox=True)
+        mock_device_store = mock.Mock()
+        mock_device_store.__class__ = AbstractDeviceStore
+
+        mock_apns = mock.Mock()
+        # the feedback removes position 1, so 2 is sent after 0
+        mock_apns.feedback_server.items.return_value = [(notifications[1].token, None)]
+        pn_relay = PushNotificationRelay('cert', 'key', True)
+        pn_relay._apns = mock_apns
+        sent = []
+
+        def mock_send_with_exception(token_hex, payload, identifier, expiry):
+            if identifier == 3 and not sent.count(3):
+                sent.append(identifier)
+                # 2, sent after 0, is rejected
+                raise InvalidTokenError(2)
+            sent.append(identifier)
+
+        mock_apns.gateway_server.send_notification = mock_send_with_exception
+        send(pn_provider=pn_provider, device_store=mock_device_store, pn_relay=pn_relay)
+        self.assertEqual(sent, [0, 2, 3, 3])
+        self.assertEqual(mock_device_store.delete_devices_with_tokens.call_args_list,
+                         [mock.call([notifications[1].token]),
+                          mock.call([notifications[2].token]),
+                          mock.call([notifications[1].token])])
+        self.assertEqual(mock_pn_store.deleted_notifications,
+                         [notifications[1], notifications[0], notifications[2], notifications[3]])
+        self.assertEqual(len(pn_provider), 0)
+
+    def test_send_invalid_token_simulated(self):
+        mock_pn_store = self.MockPushNotificationStore()
+        # keeps the tokens 64 digits long
+        mock_pn_store.t_prefix = 1
+        mock_pn_store._notifications = [mock_pn_store.generate_pn(True, APP_BUNDLE_ID1)
+                                        for i in range(5)]
+        notifications = list(mock_pn_store.get_push_notifications())
+        pn_provider = SpecificPushNotificationsProvider(PushNotificationsProvider(mock_pn_store),
+                                                        app_bundle_id=APP_BUNDLE_ID1,
+                                                        for_sandbox=True)
+        mock_device_store = mock.Mock()
+        mock_device_store.__class__ = AbstractDeviceStore
+
+        with GatewaySimulator(invalid_tokens=[notifications[1].token]) as gateway, \
+                FeedbackSimulator() as feedback:
+            pn_relay = PushNotificationRelay('cert', 'key', True, drain_timeout=0.2)
+            pn_relay._apns = APNs(enhanced=True)
+            gateway.attach(pn_relay._apns.gateway_server)
+            feedback.attach(pn_relay._apns.feedback_server)
+            send(pn_provider=pn_provider, device_store=mock_device_store, pn_relay=pn_relay)
+            pn_relay._apns.gateway_server._disconnect()
+            time.sleep(0.1)
+            self.assertEqual([n.identifier for n in gateway.notifications], [0, 2, 3, 4])
+
+        mock_device_store.delete_devices_with_tokens.assert_called_once_with(
+            [notifications[1].token])
+        self.assertEqual(sorted(mock_pn_store.deleted_notifications), sorted(notifications))
+        self.assertEqual(pn_provider.sent, 4)
+
     def test_send_shutdown_launched(self):
         mock_pn_store = self.MockPushNotificationStore()
         pn_provider = SpecificPushNotificationsProvider(PushNotificationsProvider(mock_pn_store),
@@ -442,5 +1302,290 @@ class TestManagedDelivery(unittest.TestCase):
         pn_provider = PushNotificationsProvider(mock_pn_store)
         self.assertEqual(pn_provider.get_app_bundle_ids(), [APP_BUNDLE_ID2, APP_BUNDLE_ID1])
 
+    def test_specific_pn_provider_cursor(self):
+        mock_pn_store = self.MockPushNotificationStore()
+        for i in range(4):
+            mock_pn_store._notifications.append(mock_pn_store.generate_pn(True, APP_BUNDLE_ID1))
+        notifications = [n for n in mock_pn_store.get_push_notifications()
+                         if n.app_bundle_id == APP_BUNDLE_ID1 and n.use_sandbox]
+        pn_provider = SpecificPushNotificationsProvider(PushNotificationsProvider(mock_pn_store),
+                                                        app_bundle_id=APP_BUNDLE_ID1,
+                                                        for_sandbox=True,
+                                                        delete_batch_size=3)
+        self.assertEqual(len(pn_provider), 6)
+
+        pn_provider.delete_notifications_for_tokens([notifications[3].token])
+        pn_provider.acknowledge(2)
+        self.assertEqual(len(pn_provider), 3)
+        self.assertEqual(list(pn_provider.pending()),
+                         [(2, notifications[2]), (4, notifications[4]), (5, notifications[5])])
+        self.assertEqual(mock_pn_store.deleted_notifications, notifications[3:4] + notifications[:2])
+
+        pn_provider.acknowledge(5)
+        self.assertEqual(len(pn_provider), 1)
+        self.assertEqual(mock_pn_store.deleted_notifications, notifications[3:4] + notifications[:2])
+        pn_provider.delete_notifications_for_tokens([notifications[0].token])
+        self.assertEqual(pn_provider.get_notifications(), notifications[5:])
+        pn_provider.flush()
+        self.assertEqual(mock_pn_store.deleted_notifications,
+                         notifications[3:4] + notifications[:3] + notifications[4:5])
+
+    def test_prefetch_pages(self):
+        read = []
+
+        def pages():
+            for i in range(10):
+                read.append(i)
+                yield [i]
+
+        prefetched = prefetch_pages(pages(), prefetch=2)
+        self.assertEqual(next(prefetched), [0])
+        time.sleep(0.1)
+        self.assertTrue(len(read) <= 4)
+        self.assertEqual(list(prefetched), [[i] for i in range(1, 10)])
+
+        def failing_pages():
+            yield [0]
+            raise ValueError('query failed')
+
+        prefetched = prefetch_pages(failing_pages())
+        self.assertEqual(next(prefetched), [0])
+        self.assertRaises(ValueError, next, prefetched)
+
+    def test_send_paged(self):
+        mock_pn_store = self.MockPushNotificationStore()
+        notifications = list(mock_pn_store.get_push_notifications())
+        mock_device_store = mock.Mock()
+        mock_device_store.__class__ = AbstractDeviceStore
+
+        relays = {}
+
+        def get_relay(app_bundle_id, use_sandbox):
+            mock_apns = mock.Mock()
+            mock_apns.feedback_server.items.return_value = []
+            pn_relay = PushNotificationRelay('cert', 'key', use_sandbox)
+            pn_relay._apns = mock_apns
+            relays[app_bundle_id, use_sandbox] = mock_apns
+            return pn_relay
+
+        send_paged(mock_pn_store, mock_device_store, get_relay, page_size=3)
+        self.assertEqual(len(relays), 4)
+        self.assertEqual(sorted(mock_pn_store.deleted_notifications), sorted(notifications))
+        for n in notifications:
+            gateway_server = relays[n.app_bundle_id, n.use_sandbox].gateway_server
+            self.assertIn(n.token, [c[1]['token_hex']
+                                    for c in gateway_server.send_notification.call_args_list])
+
+    def test_send_paged_errors(self):
+        mock_pn_store = self.MockPushNotificationStore()
+        mock_pn_store._notifications = [mock_pn_store.generate_pn(True, APP_BUNDLE_ID1)
+                                        for i in range(8)]
+        notifications = list(mock_pn_store.get_push_notifications())
+        mock_device_store = mock.Mock()
+        mock_device_store.__class__ = AbstractDeviceStore
+        mock_apns = mock.Mock()
+        mock_apns.feedback_server.items.return_value = []
+        sent = []
+
+        def get_relay(app_bundle_id, use_sandbox):
+            pn_relay = PushNotificationRelay('cert', 'key', use_sandbox)
+            pn_relay._apns = mock_apns
+            return pn_relay
+
+        def send_notification(token_hex, payload, identifier, expiry):
+            sent.append(identifier)
+
+        # the error for the second notification arrives while the first page drains
+        mock_apns.gateway_server.send_notification.side_effect = send_notification
+        mock_apns.gateway_server.wait_for_error_response.side_effect = [InvalidTokenError(1),
+                                                                        None, None]
+        send_paged(mock_pn_store, mock_device_store, get_relay, page_size=4)
+        self.assertEqual(sent, [0, 1, 2, 3, 2, 3, 4, 5, 6, 7])
+        mock_device_store.delete_devices_with_tokens.assert_called_once_with(
+            [notifications[1].token])
+        self.assertEqual(sorted(mock_pn_store.deleted_notifications), sorted(notifications))
+
+        # it arrives only with the second page: identifier 0 isn't one of the
+        # second page's, which is sent again
+        mock_pn_store._notifications = list(notifications)
+        mock_pn_store.deleted_notifications = []
+        mock_device_store.reset_mock()
+        del sent[:]
+
+        def send_notification(token_hex, payload, identifier, expiry):
+            sent.append(identifier)
+            if sent.count(4) == 1 and identifier == 4:
+                raise InvalidTokenError(0)
+
+        mock_apns.gateway_server.send_notification.side_effect = send_notification
+        mock_apns.gateway_server.wait_for_error_response.side_effect = None
+        send_paged(mock_pn_store, mock_device_store, get_relay, page_size=4)
+        self.assertEqual(sent, [0, 1, 2, 3, 4, 4, 5, 6, 7])
+        self.assertFalse(mock_device_store.delete_devices_with_tokens.called)
+        self.assertEqual(sorted(mock_pn_store.deleted_notifications), sorted(notifications))
+
+    def test_dispatch(self):
+        mock_pn_store = self.MockPushNotificationStore()
+        notifications = list(mock_pn_store.get_push_notifications())
+        mock_device_store = mock.Mock()
+        mock_device_store.__class__ = AbstractDeviceStore
+
+        def get_relay(app_bundle_id, use_sandbox):
+            mock_apns = mock.Mock()
+            mock_apns.feedback_server.items.return_value = [(notifications[0].token, None)]
+            if app_bundle_id == APP_BUNDLE_ID2 and not use_sandbox:
+                mock_apns.gateway_server.send_notification.side_effect = socket_error('reset')
+            pn_relay = PushNotificationRelay('cert', 'key', use_sandbox)
+            pn_relay._apns = mock_apns
+            return pn_relay
+
+        pn_provider = PushNotificationsProvider(mock_pn_store)
+        results = dispatch(pn_provider, mock_device_store, get_relay, concurrency=2)
+        self.assertEqual(sorted(results), sorted([(APP_BUNDLE_ID1, True), (APP_BUNDLE_ID1, False),
+                                                  (APP_BUNDLE_ID2, True), (APP_BUNDLE_ID2, False)]))
+        self.assertEqual(results[APP_BUNDLE_ID1, True], (1, None))
+        self.assertEqual(results[APP_BUNDLE_ID1, False], (2, None))
+        self.assertEqual(results[APP_BUNDLE_ID2, True], (2, None))
+        sent, error = results[APP_BUNDLE_ID2, False]
+        self.assertEqual(sent, 0)
+        self.assertTrue(isinstance(error, socket_error))
+        self.assertEqual(len(pn_provider), 2)
+        self.assertEqual(pn_provider.get_app_bundle_ids(), [APP_BUNDLE_ID2])
+        self.assertEqual(len(mock_pn_store.deleted_notifications), 6)
+        self.assertEqual(mock_device_store.delete_devices_with_tokens.call_count, 4)
+        self.assertEqual(dispatch(PushNotificationsProvider(mock_pn_store, []),
+                                  mock_device_store, get_relay), {})
+
+    def test_notification_queue(self):
+        mock_pn_store = self.MockPushNotificationStore()
+        campaign = mock_pn_store.get_push_notifications()[:6]
+        for n in campaign:
+            n.priority = PRIORITY_BULK
+        campaign[1].expiry = campaign[4].expiry = datetime.now() - timedelta(hours=1)
+        expired = []
+        queue = NotificationQueue(campaign, expired_callback=expired.append)
+        self.assertEqual(queue.pop_batch(2), [campaign[0], campaign[2]])
+        self.assertEqual((queue.dropped, expired), (2, [campaign[1], campaign[4]]))
+
+        urgent = mock_pn_store.generate_pn(True, APP_BUNDLE_ID1)
+        soon = mock_pn_store.generate_pn(True, APP_BUNDLE_ID1)
+        soon.priority = PRIORITY_BULK
+        soon.expiry = datetime.now() + timedelta(hours=1)
+        queue.extend([urgent, soon])
+        self.assertEqual(queue.pop(), urgent)
+        self.assertEqual(queue.pop_batch(10), [soon, campaign[3], campaign[5]])
+        self.assertEqual((queue.dropped, expired), (2, [campaign[1], campaign[4]]))
+        self.assertEqual(queue.pop(), None)
+        self.assertEqual(len(queue), 0)
+
+    def test_send_by_priority(self):
+        mock_pn_store = self.MockPushNotificationStore()
+        campaign = [n for n in mock_pn_store.get_push_notifications()
+                    if n.app_bundle_id == APP_BUNDLE_ID1 and n.use_sandbox]
+        for n in campaign:
+            n.priority = PRIORITY_BULK
+        urgent = mock_pn_store.generate_pn(True, APP_BUNDLE_ID1)
+        mock_pn_store._notifications.append(urgent)
+        pn_provider = SpecificPushNotificationsProvider(PushNotificationsProvider(mock_pn_store),
+                                                        app_bundle_id=APP_BUNDLE_ID1,
+                                                        for_sandbox=True)
+        mock_device_store = mock.Mock()
+        mock_device_store.__class__ = AbstractDeviceStore
+        mock_apns = mock.Mock()
+        mock_apns.feedback_server.items.return_value = []
+        pn_relay = PushNotificationRelay('cert', 'key', True)
+        pn_relay._apns = mock_apns
+
+        send(pn_provider=pn_provider, device_store=mock_device_store, pn_relay=pn_relay)
+        self.assertEqual([(c[1]['token_hex'], c[1]['identifier'])
+                          for c in mock_apns.gateway_server.send_notification.call_args_list],
+                         [(urgent.token, 0), (campaign[0].token, 1), (campaign[1].token, 2)])
+
+    def test_send_drops_expired(self):
+        mock_pn_store = self.MockPushNotificationStore()
+        notifications = list(mock_pn_store.get_push_notifications())
+        notifications[0].expiry = datetime.now() - timedelta(hours=1)
+        pn_provider = SpecificPushNotificationsProvider(PushNotificationsProvider(mock_pn_store),
+                                                        app_bundle_id=APP_BUNDLE_ID1,
+                                                        for_sandbox=True)
+        self.assertEqual((pn_provider.dropped, len(pn_provider)), (1, 1))
+        mock_device_store = mock.Mock()
+        mock_device_store.__class__ = AbstractDeviceStore
+        mock_apns = mock.Mock()
+        mock_apns.feedback_server.items.return_value = []
+        pn_relay = PushNotificationRelay('cert', 'key', True)
+        pn_relay._apns = mock_apns
+
+        send(pn_provider=pn_provider, device_store=mock_device_store, pn_relay=pn_relay)
+        self.assertEqual(mock_apns.gateway_server.send_notification.call_args_list,
+                         [mock.call(token_hex=notifications[1].token,
+                                    payload=notifications[1].payload,
+                                    identifier=1,
+                                    expiry=notifications[1].expiry)])
+        self.assertEqual(mock_pn_store.deleted_notifications, notifications[:2])
+        self.assertEqual(pn_provider.sent, 1)
+
+    def test_notification_coalescer(self):
+        mock_pn_store = self.MockPushNotificationStore()
+        first, second, other = mock_pn_store.get_push_notifications()[:3]
+        newer = mock_pn_store.generate_pn(True, APP_BUNDLE_ID1)
+        newer.token = first.token
+        badge = mock_pn_store.generate_pn(True, APP_BUNDLE_ID1)
+        badge.token = first.token
+        badge.payload = Payload(badge=3, custom={'collapse_key': 'badge'})
+
+        superseded = []
+        coalescer = NotificationCoalescer(window=5, superseded_callback=superseded.append)
+        coalescer.add(first, now=100)
+        coalescer.add(second, now=101)
+        coalescer.add(newer, now=102)
+        coalescer.add(badge, now=103)
+        coalescer.add(other, now=106)
+        self.assertEqual((coalescer.coalesced, superseded), (1, [first]))
+        self.assertEqual(len(coalescer), 4)
+        self.assertEqual(coalescer.ready(now=104), [])
+        self.assertEqual(coalescer.ready(now=106), [newer, second])
+        self.assertEqual(coalescer.drain(), [badge, other])
+        self.assertEqual(len(coalescer), 0)
+
+    def test_send_coalesced(self):
+        mock_pn_store = self.MockPushNotificationStore()
+        notifications = list(mock_pn_store.get_push_notifications())
+        notifications[0].payload = Payload(badge=1, custom={'collapse_key': 'badge'})
+        newer = mock_pn_store.generate_pn(True, APP_BUNDLE_ID1)
+        newer.token = notifications[0].token
+        newer.payload = Payload(badge=2, custom={'collapse_key': 'badge'})
+        # a different alert for the same device, without a collapse key
+        alert = mock_pn_store.generate_pn(True, APP_BUNDLE_ID1)
+        alert.token = notifications[1].token
+        mock_pn_store._notifications.extend([newer, alert])
+        pn_provider = SpecificPushNotificationsProvider(PushNotificationsProvider(mock_pn_store),
+                                                        app_bundle_id=APP_BUNDLE_ID1,
+                                                        for_sandbox=True, coalesce=True)
+        self.assertEqual(pn_provider.coalesced, 1)
+        self.assertEqual([n for position, n in pn_provider.pending()],
+                         [notifications[1], newer, alert])
+
+    def test_pn_provider_indexes(self):
+        mock_pn_store = self.MockPushNotificationStore()
+        notifications = mock_pn_store.get_push_notifications()
+        pn_provider = PushNotificationsProvider(mock_pn_store)
+        self.assertEqual(len(pn_provider), 8)
+        self.assertEqual(pn_provider.get_notifications(APP_BUNDLE_ID1, False), notifications[2:4])
+        self.assertEqual(pn_provider.get_notifications(APP_BUNDLE_ID2, True), notifications[4:6])
+        self.assertEqual(pn_provider.get_notifications('com.app.3', True), [])
+
+        tokens = [notifications[0].token, notifications[5].token, 'unknown']
+        self.assertEqual(sorted(pn_provider.get_notifications_for_tokens(tokens)),
+                         sorted([notifications[0], notifications[5]]))
+        self.assertEqual(pn_provider.get_notifications_for_tokens(tokens, APP_BUNDLE_ID2, True),
+                         [notifications[5]])
+
+        pn_provider.delete_notifications(notifications[4:8])
+        self.assertEqual(len(pn_provider), 4)
+        self.assertEqual(pn_provider.get_app_bundle_ids(), [APP_BUNDLE_ID1])
+        self.assertEqual(pn_provider.get_notifications_for_tokens(tokens), [notifications[0]])
+        self.assertEqual(mock_pn_store.deleted_notifications, notifications[4:8])
+
 if __name__ == '__main__':
     unittest.main()